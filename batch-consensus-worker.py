@@ -0,0 +1,47 @@
+import argparse
+from batch_consensus import BatchConsensus, ValueBatcher
+import worker
+
+# python3 batch-consensus-worker.py --nodes localhost:9000 --node_identity 0 --byz_quorum 1 --round_duration 3 --heights 0 --transport direct
+# Submit values with: curl -X POST --data-binary $'value1\nvalue2' http://localhost:9000/values
+
+parser = argparse.ArgumentParser()
+worker.add_arguments(parser)
+parser.add_argument(
+    "--batch_count",
+    type = int,
+    default = 500,
+    help = "Maximum number of values in a batch"
+)
+parser.add_argument(
+    "--batch_bytes",
+    type = int,
+    default = 1<<20,
+    help = "Maximum total size (in bytes) of the values in a batch"
+)
+parser.add_argument(
+    "--batch_wait",
+    type = float,
+    default = 0.05,
+    help = "Time (in seconds) that the leader waits for a full batch before proposing a smaller one"
+)
+args = parser.parse_args()
+
+worker.setup_logging(args, ['consensus', 'network', 'manager', 'wal', 'batch_consensus'], name_width=15)
+
+if __name__ == '__main__':
+    # One batcher for all heights, so values that were not decided at one height are proposed at the next
+    batcher = ValueBatcher(max_count=args.batch_count, max_bytes=args.batch_bytes, max_wait=args.batch_wait)
+
+    def post_values(path, headers, body):
+        # One value per line
+        try:
+            values = body.decode().splitlines()
+        except UnicodeDecodeError:
+            return 400, 'text/plain', b'Values must be UTF-8 text'
+        for value in values:
+            if value:
+                batcher.submit(value)
+        return 200, 'text/plain', b'Values received'
+
+    worker.run(args, BatchConsensus, routes=[('POST', '/values', post_values)], batcher=batcher)
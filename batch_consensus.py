@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from consensus import Consensus, ConsensusMessage
+from value_store import value_digest, is_value_digest
+import logging
+
+log = logging.getLogger(__name__)
+
+def batch_digest(batch):
+    return value_digest(list(batch))
+
+class ValueBatcher:
+    def __init__(self, max_count=500, max_bytes=1<<20, max_wait=0.05):
+        # Pending values submitted to this node, shared by the instances of all heights
+        # A batch holds at most `max_count` values and `max_bytes` bytes of values. The leader waits up to `max_wait` seconds for a full batch.
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        # `pending` maps value -> size in bytes, in submission order. Submitting a value twice has no effect.
+        self.pending = OrderedDict()
+        # Values in a batch that this node proposed, which is not decided yet. They are not put in another batch.
+        self.in_flight = set()
+        self.available_bytes = 0
+        self.condition = threading.Condition()
+
+    def submit(self, value: str):
+        assert type(value) == str, "Values must be strings"
+        with self.condition:
+            if value in self.pending:
+                return
+            self.pending[value] = len(value.encode())
+            self.available_bytes += self.pending[value]
+            self.condition.notify_all()
+
+    def is_full(self):
+        return len(self.pending) - len(self.in_flight) >= self.max_count or self.available_bytes >= self.max_bytes
+
+    def next_batch(self, wait=True):
+        # Waits until a full batch is pending or `max_wait` has passed if `wait` is True, then returns the oldest pending values that are not in flight
+        # The batch can be empty
+        deadline = time.monotonic() + self.max_wait
+        with self.condition:
+            while wait and not self.is_full():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            batch_bytes = 0
+            for value, size in self.pending.items():
+                if len(batch) == self.max_count:
+                    break
+                if value in self.in_flight:
+                    continue
+                if batch and batch_bytes + size > self.max_bytes:
+                    break
+                batch.append(value)
+                batch_bytes += size
+            self.in_flight.update(batch)
+            self.available_bytes -= batch_bytes
+            return batch
+
+    def release(self, batch):
+        # Makes the values of a proposed batch that was not decided available for another batch
+        with self.condition:
+            for value in batch:
+                if value in self.in_flight:
+                    self.in_flight.discard(value)
+                    self.available_bytes += self.pending[value]
+            self.condition.notify_all()
+
+    def remove(self, batch):
+        # Drops the values of a decided batch, whoever proposed it
+        with self.condition:
+            for value in batch:
+                if value not in self.pending:
+                    continue
+                size = self.pending.pop(value)
+                if value in self.in_flight:
+                    self.in_flight.discard(value)
+                else:
+                    self.available_bytes -= size
+
+class BatchConsensus(Consensus):
+    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None, broadcaster=None, signer=None, height=0, value_store=None, timers=None, timeout_policy=None, leader_schedule=None, verifier=None, batcher=None):
+        # Forms consensus on a batch of values. The PRE_PREPARE carries the batch and its digest,
+        # PREPARE, COMMIT and ROUND_CHANGE messages only carry the digest as their value.
+        # `batcher` is the `ValueBatcher` that the batches proposed by this node are taken from
+        self.batcher = batcher if batcher is not None else ValueBatcher()
+        # `batches` maps digest -> batch of the batches that were proposed in this instance and are valid
+        self.batches = {}
+        # Batches that this node proposed in this instance
+        self.proposed_batches = []
+        super().__init__(nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=node_identity, broadcaster=broadcaster, signer=signer, height=height, value_store=value_store, timers=timers, timeout_policy=timeout_policy, leader_schedule=leader_schedule, verifier=verifier)
+
+    def broadcast_proposal(self, value=None, justification=[]):
+        if value is None and self.timers is not None and not self.batcher.is_full():
+            # Values are received on the thread that runs the timers, so the leader waits for a full batch on a timer instead of blocking
+            round = self.store.get_round()
+            def propose():
+                if self.store.get_round() == round and self.store.get_state() != "DECIDED":
+                    super(BatchConsensus, self).broadcast_proposal(value, justification)
+            self.timers.call_later(self.batcher.max_wait, propose)
+            return
+        super().broadcast_proposal(value, justification)
+
+    def create_proposal(self, value=None, justification=[]):
+        round = self.store.get_round()
+        data = {}
+        if value is None:
+            batch = self.batcher.next_batch(wait=self.timers is None)
+            value = batch_digest(batch)
+            self.batches[value] = batch
+            self.proposed_batches.append(batch)
+            log.info(f'Proposing batch {value} of {len(batch)} values')
+        assert value in self.batches, "Re-proposing a batch that this node does not have"
+        data['value'] = value
+        data['batch'] = self.batches[value]
+        data['justification'] = justification
+        sender = self.node_identity
+        return ConsensusMessage("PRE_PREPARE", round, data, sender, height=self.height)
+
+    def validate_value(self, value):
+        # NOTE: Validate a single value of a batch according to application-specific logic
+        return type(value) == str
+
+    def validate_message_data(self, data):
+        assert is_value_digest(data['value']), "Incorrect type for message data"
+        if 'batch' not in data:
+            # PREPARE and COMMIT messages only carry the digest
+            return True
+        if data['value'] in self.batches:
+            # The batch was already checked, e.g. when it is re-proposed in a later round
+            return True
+        batch = data['batch']
+        assert type(batch) in [list, tuple], "Incorrect type for batch"
+        if batch_digest(batch) != data['value'] or not all(self.validate_value(value) for value in batch):
+            return False
+        self.batches[data['value']] = list(batch)
+        return True
+
+    def value_reference(self, value):
+        # The value of a PRE_PREPARE message is already the digest of its batch
+        return value
+
+    def store_value(self, data):
+        # The value store serves batches by their digest, `batch_digest` is the `value_digest` of the batch
+        self.value_store.put(self.batches[data['value']])
+
+    def resolve_value(self, reference, callback, node_indices=()):
+        # A batch is re-proposed by its digest, which is only possible if this node has the batch. Batches that this node never
+        # received are fetched from the value store if there is one. `callback` gets None if the batch is not available.
+        if reference is None or reference in self.batches:
+            callback(reference)
+            return
+        if self.value_store is None:
+            callback(None)
+            return
+        def resolved(batch):
+            if batch is None or not self.validate_message_data({'value': reference, 'batch': batch}):
+                callback(None)
+            else:
+                callback(reference)
+        super().resolve_value(reference, resolved, node_indices)
+
+    def get_decided_batch(self):
+        # Returns None if the decided batch was never received by this node
+        return self.batches.get(self.store.get_decided_value())
+
+    def process_message(self, message):
+        process_msg_result = super().process_message(message)
+        if process_msg_result == "STOP_TIMER":
+            self.resolve_decided_value(self.remove_decided_batch)
+        return process_msg_result
+
+    def remove_decided_batch(self, digest):
+        # `digest` is None if the decided batch could not be fetched
+        decided_batch = self.get_decided_batch()
+        if decided_batch is None:
+            log.warning(f'Decided on batch {self.store.get_decided_value()} without receiving it')
+        else:
+            log.info(f'Decided on batch {self.store.get_decided_value()} of {len(decided_batch)} values')
+            self.batcher.remove(decided_batch)
+        for batch in self.proposed_batches:
+            self.batcher.release(batch)
@@ -0,0 +1,66 @@
+import queue
+import threading
+import time
+import pika
+import logging
+
+log = logging.getLogger(__name__)
+
+def queue_name(node_identity):
+    return 'ibft_node_'+str(node_identity)
+
+class RabbitMQPublisher:
+    def __init__(self, routing_key, host='localhost', reconnect_delay=1, max_pending=0):
+        # `routing_key` is the name of the queue that messages are published to
+        # One long-lived connection and channel, owned by a single publisher thread since pika connections are not thread-safe
+        # Any thread can call `publish`, which only enqueues the body for the publisher thread
+        # At most `max_pending` bodies wait to be published, or any number if it is 0
+        self.routing_key = routing_key
+        self.host = host
+        self.reconnect_delay = reconnect_delay
+        self.pending = queue.Queue(max_pending)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, body: bytes, block=True, timeout=None):
+        # Raises `queue.Full` if `max_pending` bodies are still waiting after `timeout` seconds, or right away if `block` is False
+        self.pending.put(body, block, timeout)
+
+    def connect(self):
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        channel = connection.channel()
+        # Declare the queue once per connection, not once per message
+        channel.queue_declare(queue=self.routing_key)
+        return connection, channel
+
+    def run(self):
+        body = None
+        while not self.stopped.is_set() or not self.pending.empty():
+            try:
+                connection, channel = self.connect()
+            except pika.exceptions.AMQPError:
+                log.error(f'Failed to connect to RabbitMQ at {self.host}', exc_info=True)
+                time.sleep(self.reconnect_delay)
+                continue
+            try:
+                while not self.stopped.is_set() or not self.pending.empty():
+                    if body is None:
+                        try:
+                            body = self.pending.get(timeout=0.5)
+                        except queue.Empty:
+                            # Keep the connection alive (heartbeats) while idle
+                            connection.process_data_events(time_limit=0)
+                            continue
+                    channel.basic_publish(exchange='', routing_key=self.routing_key, body=body)
+                    body = None
+                connection.close()
+            except pika.exceptions.AMQPError:
+                # `body` is kept and published again after reconnecting
+                log.error(f'Lost connection to RabbitMQ at {self.host}, reconnecting', exc_info=True)
+                time.sleep(self.reconnect_delay)
+
+    def close(self, timeout=5):
+        # Publishes pending messages for up to `timeout` seconds before returning
+        self.stopped.set()
+        self.thread.join(timeout)
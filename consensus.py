@@ -1,11 +1,37 @@
+import concurrent.futures
 import json
+import struct
+import hashlib
+from collections import OrderedDict
+from types import MappingProxyType
 import httpx
 import datetime
 import math
 import time
+from signing import SignatureVerifier, verify_message_signature
+from value_store import value_digest, is_value_digest, fetched_value
+from timeout_policy import ExponentialTimeout
+from leader_schedule import RoundRobinSchedule
+from metrics import Counter, Histogram
+from logs import Lazy, SampledLog
 import logging
 
 log = logging.getLogger(__name__)
+# Logs of every processed message
+message_log = SampledLog(log)
+
+PHASE_SECONDS = Histogram('consensus_phase_seconds', 'Time from the start of a round to PREPARED, from PREPARED to COMMITTED, and from COMMITTED to DECIDED', ['phase'])
+ROUND_CHANGES = Counter('consensus_round_changes_total', 'Round changes, after a round timeout or a ROUND_CHANGE jump to a higher round', ['reason'])
+
+# Wire formats of a serialized ConsensusMessage
+# JSON messages start with '{', binary messages start with one of the version bytes in `BINARY_WIRE_VERSIONS`
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-kofta'
+BINARY_WIRE_VERSION_1 = 0x01
+BINARY_WIRE_VERSION = 0x02
+BINARY_WIRE_VERSIONS = [BINARY_WIRE_VERSION_1, BINARY_WIRE_VERSION]
+# Several messages can be sent in one body: a JSON array of messages, or a binary batch frame (see `encode_batch`)
+BINARY_BATCH_VERSION = 0x10
 
 class ConsensusNode:
     def __init__(self, node_index, weight=1, public_key=""):
@@ -14,24 +40,85 @@ class ConsensusNode:
         self.public_key = public_key
 
 class ConsensusMessage:
-    def __init__(self, type: str, round: int, data, sender: int, signature=""):
+    # Messages are immutable, so their serializations and digest are computed at most once and then reused,
+    # also when the message is embedded in the justification of other messages
+    __slots__ = ('type', 'round', 'data', 'sender', 'siganture', 'height', '_dict', '_string', '_body', '_bytes', '_digest', '_signing_digest')
+
+    def __init__(self, type: str, round: int, data, sender: int, signature="", height=0):
         # `type` can be "PRE_PREPARE", "PREPARE", "COMMIT", "ROUND_CHANGE"
-        self.type = type
-        self.round = int(round)
-        self.data = data
-        self.sender = int(sender)
-        self.siganture = signature
-
-    def verify_signature(self):
-        # TODO: Implement siganture verification
-        return True
+        # `height` identifies the consensus instance that the message belongs to
+        data = dict(data)
+        if 'justification' in data:
+            data['justification'] = tuple(data['justification'])
+            assert all(msg.height == height for msg in data['justification']), "Justification from a different height"
+        round, sender, height = int(round), int(sender), int(height)
+        # The binary encoding packs round and sender as u32 and height as u64
+        assert 0 <= round < 2**32, "Round out of range: "+str(round)
+        assert 0 <= sender < 2**32, "Sender out of range: "+str(sender)
+        assert 0 <= height < 2**64, "Height out of range: "+str(height)
+        init = object.__setattr__
+        init(self, 'type', type)
+        init(self, 'round', round)
+        # `data` is a read-only view
+        init(self, 'data', MappingProxyType(data))
+        init(self, 'sender', sender)
+        init(self, 'siganture', signature)
+        init(self, 'height', height)
+        # The cached slots `_dict`, `_string`, `_body`, `_bytes`, `_digest` and `_signing_digest` stay unset until first used
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConsensusMessage is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ConsensusMessage is immutable")
+
+    def _cache(self, name, value):
+        object.__setattr__(self, name, value)
+        return value
+
+    def signing_digest(self):
+        # SHA-256 of the binary encoding without the signature and the certificate, this is what the sender signs
+        cached = getattr(self, '_signing_digest', None)
+        if cached is not None:
+            return cached
+        unsigned = self
+        if self.siganture != "" or 'certificate' in self.data:
+            data = {key: value for key, value in self.data.items() if key != 'certificate'}
+            unsigned = ConsensusMessage(self.type, self.round, data, self.sender, height=self.height)
+        return self._cache('_signing_digest', hashlib.sha256(unsigned.to_bytes()).digest())
+
+    def with_signature(self, signature):
+        signed = ConsensusMessage(self.type, self.round, self.data, self.sender, signature, height=self.height)
+        signed._cache('_signing_digest', self.signing_digest())
+        return signed
+
+    def without_certificate(self):
+        # A certificate proves itself and is not signed, so it can be left out without changing the signature, see `create_certificate`
+        if 'certificate' not in self.data:
+            return self
+        data = {key: value for key, value in self.data.items() if key != 'certificate'}
+        stripped = ConsensusMessage(self.type, self.round, data, self.sender, self.siganture, height=self.height)
+        stripped._cache('_signing_digest', self.signing_digest())
+        return stripped
+
+    def verify_signature(self, public_key=""):
+        # Messages of networks without keys are unsigned
+        # `Consensus` checks signatures with its `SignatureVerifier` instead, which also covers justifications and caches results
+        if not public_key:
+            return True
+        return verify_message_signature(self, public_key)
 
     def to_dict(self):
+        # The returned dict is cached and shared, it must not be modified
+        cached = getattr(self, '_dict', None)
+        if cached is not None:
+            return cached
         d = {
             'type': self.type,
             'round': self.round,
             'sender': self.sender,
-            'siganture': self.siganture
+            'siganture': self.siganture,
+            'height': self.height
         }
         d['data'] = {}
         d['data']['justification'] = []
@@ -41,15 +128,25 @@ class ConsensusMessage:
                     d['data']['justification'].append(msg.to_dict())
             else:
                 d['data'][key] = self.data[key]
-        return d
+        return self._cache('_dict', d)
 
     def to_string(self):
-        return json.dumps(self.to_dict())
+        cached = getattr(self, '_string', None)
+        if cached is not None:
+            return cached
+        return self._cache('_string', json.dumps(self.to_dict()))
 
     def __str__(self):
         # Useful for printing the object directly
         return self.to_string()
 
+    def digest(self):
+        # Hex SHA-256 of the binary encoding, identifies the message including its signature
+        cached = getattr(self, '_digest', None)
+        if cached is not None:
+            return cached
+        return self._cache('_digest', hashlib.sha256(self.to_bytes()).hexdigest())
+
     @classmethod
     def from_dict(self, d):
         # TODO: Validate the dict `d`
@@ -66,16 +163,364 @@ class ConsensusMessage:
                 d['round'],
                 data,
                 d['sender'],
-                d['siganture']
+                d['siganture'],
+                # Messages without a height are from nodes that run a single instance
+                d.get('height', 0)
         )
 
     @classmethod
     def from_string(self, s):
         return ConsensusMessage.from_dict(json.loads(s))
 
+    def to_bytes(self):
+        # Versioned binary encoding, see `encode_message_body`
+        cached = getattr(self, '_bytes', None)
+        if cached is not None:
+            return cached
+        if self.height == 0:
+            # Single-instance messages keep the version 1 frame, so they can be read by nodes without heights
+            frame_header = bytes([BINARY_WIRE_VERSION_1])
+        else:
+            frame_header = bytes([BINARY_WIRE_VERSION]) + U64.pack(self.height)
+        try:
+            body = self.encode_body({})
+        except struct.error as e:
+            # Same as `from_bytes`, e.g. for a string or list in `data` that is too long for its length field
+            raise ValueError("Message cannot be encoded") from e
+        return self._cache('_bytes', frame_header + body)
+
+    def encode_body(self, refs):
+        # The body of a message without a justification does not depend on the rest of the frame,
+        # so it is encoded once and then copied into every frame that embeds the message
+        cached = getattr(self, '_body', None)
+        if cached is not None:
+            return cached
+        body = encode_message_body(self, refs)
+        if len(self.data.get('justification', ())) == 0:
+            self._cache('_body', body)
+        return body
+
+    @classmethod
+    def from_bytes(self, b):
+        b = memoryview(b)
+        assert len(b) > 0 and b[0] in BINARY_WIRE_VERSIONS, "Unknown binary wire format version"
+        try:
+            if b[0] == BINARY_WIRE_VERSION_1:
+                frame, offset = DecodeFrame(0), 1
+            else:
+                frame, offset = DecodeFrame(U64.unpack_from(b, 1)[0]), 1 + U64.size
+            message, offset = decode_message_body(b, offset, frame)
+        except (struct.error, IndexError) as e:
+            raise ValueError("Truncated binary message") from e
+        assert offset == len(b), "Trailing bytes after binary message"
+        # The received bytes are a valid encoding of `message`, so they are kept instead of encoding it again
+        message._cache('_bytes', bytes(b))
+        return message
+
+    def encode(self, wire_format="binary"):
+        # Returns (content_type, body)
+        if wire_format == "binary":
+            return BINARY_CONTENT_TYPE, self.to_bytes()
+        return JSON_CONTENT_TYPE, self.to_string().encode()
+
+    @classmethod
+    def decode(self, body):
+        # Accepts both wire formats, the format is detected from the first byte
+        if len(body) > 0 and body[0] in BINARY_WIRE_VERSIONS:
+            return ConsensusMessage.from_bytes(body)
+        return ConsensusMessage.from_string(body)
+
+def encode_batch(messages, wire_format="binary"):
+    # Returns (content_type, body) of a batch of `messages`
+    # Binary batch frame: version byte, number of messages (u32), then the length (u32) and binary frame of every message
+    if wire_format == "binary":
+        parts = [bytes([BINARY_BATCH_VERSION]), U32.pack(len(messages))]
+        for message in messages:
+            frame = message.to_bytes()
+            parts.append(U32.pack(len(frame)))
+            parts.append(frame)
+        return BINARY_CONTENT_TYPE, b''.join(parts)
+    return JSON_CONTENT_TYPE, ('[' + ','.join(message.to_string() for message in messages) + ']').encode()
+
+def decode_messages(body):
+    # Returns the list of messages of `body`, which is a single message or a batch in either wire format
+    if len(body) > 0 and body[0] == BINARY_BATCH_VERSION:
+        b = memoryview(body)
+        messages = []
+        try:
+            count = U32.unpack_from(b, 1)[0]
+            offset = 1 + U32.size
+            for i in range(count):
+                length = U32.unpack_from(b, offset)[0]
+                offset += U32.size
+                assert offset + length <= len(b), "Truncated binary batch"
+                messages.append(ConsensusMessage.from_bytes(b[offset:offset+length]))
+                offset += length
+        except struct.error as e:
+            raise ValueError("Truncated binary batch") from e
+        assert offset == len(b), "Trailing bytes after binary batch"
+        return messages
+    if len(body) > 0 and body.lstrip()[:1] in [b'[', '[']:
+        return [ConsensusMessage.from_dict(d) for d in json.loads(body)]
+    return [ConsensusMessage.decode(body)]
+
+# Binary frame: version byte, then the height (u64) for version 2 frames, then the message body.
+# All messages nested in a frame have the height of the frame.
+# Binary layout of a message body:
+#   header: type code (u8), round (u32), sender (u32)
+#   signature: tagged value
+#   data: dict, encoded as below without the leading tag. An empty justification is left out.
+# Values inside `data` are tagged with one byte. Dict keys used by the protocol are sent as one-byte codes.
+# Lowercase hex strings (signatures, digests, drand randomness) are sent as raw bytes.
+# A nested message that was already sent earlier in the same frame is sent as a back-reference to it, so
+# the PREPARE quorum shared by many ROUND_CHANGE messages in a justification is only sent once.
+MESSAGE_TYPE_CODES = {"PRE_PREPARE": 0, "PREPARE": 1, "COMMIT": 2, "ROUND_CHANGE": 3}
+MESSAGE_TYPES = {code: type for type, code in MESSAGE_TYPE_CODES.items()}
+KEY_CODES = {'justification': 1, 'value': 2, 'prepared_round': 3, 'prepared_value': 4, 'certificate': 5, 'signers': 6, 'signatures': 7}
+KEYS = {code: key for key, code in KEY_CODES.items()}
+HEADER = struct.Struct('>BII')
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_BIGINT, TAG_FLOAT, TAG_STR, TAG_HEX, TAG_BYTES, TAG_LIST, TAG_DICT, TAG_MESSAGE, TAG_MESSAGE_REF = range(13)
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+def encode_message_body(message, refs):
+    # `refs` maps the body of every nested message encoded so far in this frame to its back-reference index
+    assert message.type in MESSAGE_TYPE_CODES, "Unknown message type: "+str(message.type)
+    parts = [HEADER.pack(MESSAGE_TYPE_CODES[message.type], message.round, message.sender)]
+    encode_value(message.siganture, parts, refs)
+    encode_dict(message.data, parts, refs)
+    return b''.join(parts)
+
+class DecodeFrame:
+    def __init__(self, height):
+        self.height = height
+        # `refs` lists the nested messages decoded so far in this frame, in back-reference order
+        self.refs = []
+
+def decode_message_body(b, offset, frame):
+    start = offset
+    type_code, round, sender = HEADER.unpack_from(b, offset)
+    assert type_code in MESSAGE_TYPES, "Unknown message type code: "+str(type_code)
+    signature, offset = decode_value(b, offset + HEADER.size, frame)
+    data, offset = decode_dict(b, offset, frame)
+    # Same as `from_dict`, every decoded message has a justification
+    if 'justification' not in data:
+        data['justification'] = []
+    message = ConsensusMessage(MESSAGE_TYPES[type_code], round, data, sender, signature, frame.height)
+    if len(data['justification']) == 0:
+        # Same as `encode_body`, the body of a message without a justification is kept for reuse
+        message._cache('_body', bytes(b[start:offset]))
+    return message, offset
+
+def encode_dict(d, parts, refs):
+    # Keys are encoded in sorted order, so that the encoding (and with it the signature) does not depend on the key order of `d`,
+    # which does not survive a JSON round trip
+    items = sorted(((key, value) for key, value in d.items() if not (key == 'justification' and len(value) == 0)), key=lambda item: item[0])
+    parts.append(U16.pack(len(items)))
+    for key, value in items:
+        if key in KEY_CODES:
+            parts.append(U8.pack(KEY_CODES[key]))
+        else:
+            key = key.encode()
+            parts.append(U8.pack(0) + U16.pack(len(key)) + key)
+        encode_value(value, parts, refs)
+
+def decode_dict(b, offset, frame):
+    (count,) = U16.unpack_from(b, offset)
+    offset += U16.size
+    d = {}
+    for i in range(count):
+        key_code = b[offset]
+        offset += 1
+        if key_code != 0:
+            key = KEYS[key_code]
+        else:
+            (key_length,) = U16.unpack_from(b, offset)
+            offset += U16.size
+            key = bytes(b[offset:offset+key_length]).decode()
+            offset += key_length
+        d[key], offset = decode_value(b, offset, frame)
+    return d, offset
+
+def encode_value(value, parts, refs):
+    if value is None:
+        parts.append(U8.pack(TAG_NONE))
+    elif value is True or value is False:
+        parts.append(U8.pack(TAG_TRUE if value else TAG_FALSE))
+    elif isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            parts.append(U8.pack(TAG_INT) + I64.pack(value))
+        else:
+            digits = str(value).encode()
+            parts.append(U8.pack(TAG_BIGINT) + U16.pack(len(digits)) + digits)
+    elif isinstance(value, float):
+        parts.append(U8.pack(TAG_FLOAT) + F64.pack(value))
+    elif isinstance(value, str):
+        if len(value) > 0 and len(value) % 2 == 0 and HEX_DIGITS.issuperset(value):
+            raw = bytes.fromhex(value)
+            parts.append(U8.pack(TAG_HEX) + U32.pack(len(raw)) + raw)
+        else:
+            raw = value.encode()
+            parts.append(U8.pack(TAG_STR) + U32.pack(len(raw)) + raw)
+    elif isinstance(value, (bytes, bytearray)):
+        parts.append(U8.pack(TAG_BYTES) + U32.pack(len(value)) + bytes(value))
+    elif isinstance(value, ConsensusMessage):
+        body = value.encode_body(refs)
+        if body in refs:
+            parts.append(U8.pack(TAG_MESSAGE_REF) + U32.pack(refs[body]))
+        else:
+            refs[body] = len(refs)
+            parts.append(U8.pack(TAG_MESSAGE) + U32.pack(len(body)) + body)
+    elif isinstance(value, (list, tuple)):
+        parts.append(U8.pack(TAG_LIST) + U32.pack(len(value)))
+        for item in value:
+            encode_value(item, parts, refs)
+    elif isinstance(value, dict):
+        parts.append(U8.pack(TAG_DICT))
+        encode_dict(value, parts, refs)
+    else:
+        raise TypeError("Cannot encode value of type "+type(value).__name__)
+
+def decode_value(b, offset, frame):
+    tag = b[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_INT:
+        return I64.unpack_from(b, offset)[0], offset + I64.size
+    elif tag == TAG_BIGINT:
+        (length,) = U16.unpack_from(b, offset)
+        offset += U16.size
+        return int(bytes(b[offset:offset+length])), offset + length
+    elif tag == TAG_FLOAT:
+        return F64.unpack_from(b, offset)[0], offset + F64.size
+    elif tag == TAG_STR:
+        (length,) = U32.unpack_from(b, offset)
+        offset += U32.size
+        return bytes(b[offset:offset+length]).decode(), offset + length
+    elif tag == TAG_HEX:
+        (length,) = U32.unpack_from(b, offset)
+        offset += U32.size
+        return b[offset:offset+length].hex(), offset + length
+    elif tag == TAG_BYTES:
+        (length,) = U32.unpack_from(b, offset)
+        offset += U32.size
+        return bytes(b[offset:offset+length]), offset + length
+    elif tag == TAG_MESSAGE:
+        (length,) = U32.unpack_from(b, offset)
+        offset += U32.size
+        message, end = decode_message_body(b, offset, frame)
+        assert end == offset + length, "Length mismatch for nested message"
+        frame.refs.append(message)
+        return message, end
+    elif tag == TAG_MESSAGE_REF:
+        (index,) = U32.unpack_from(b, offset)
+        assert index < len(frame.refs), "Unknown back-reference to nested message"
+        return frame.refs[index], offset + U32.size
+    elif tag == TAG_LIST:
+        (count,) = U32.unpack_from(b, offset)
+        offset += U32.size
+        items = []
+        for i in range(count):
+            item, offset = decode_value(b, offset, frame)
+            items.append(item)
+        return items, offset
+    elif tag == TAG_DICT:
+        return decode_dict(b, offset, frame)
+    raise ValueError("Unknown value tag: "+str(tag))
+
+# Quorum certificates
+# A ROUND_CHANGE message proves its prepared value with a certificate of the PREPARE quorum instead of the PREPARE messages:
+# a bitmap of the senders (bit i for node index i, as hex) and their signatures, in sender order. The PREPARE messages of a quorum
+# only differ in their sender and signature, so they are rebuilt from the certificate to check it. Ed25519 signatures cannot be
+# aggregated, so a certificate still holds one signature per sender, but none of the rest of the messages.
+
+def bitmap_size(bits):
+    # Bytes of a signer bitmap of `bits` bits
+    return (bits + 7) // 8
+
+def create_certificate(messages):
+    # `messages` are votes from distinct senders for the same round and value, e.g. a PREPARE quorum
+    messages = sorted(messages, key=lambda message: message.sender)
+    signers = 0
+    for message in messages:
+        assert message.sender >= 0 and not signers >> message.sender & 1, "Certificate needs distinct, non-negative senders"
+        signers |= 1 << message.sender
+    return {'signers': signers.to_bytes(bitmap_size(signers.bit_length()), 'little').hex(), 'signatures': [message.siganture for message in messages]}
+
+def certificate_signers(certificate):
+    # Returns the node indices in the bitmap of `certificate`, in increasing order
+    signers = certificate['signers']
+    assert type(signers) == str and len(signers) % 2 == 0 and HEX_DIGITS.issuperset(signers), "Incorrect signer bitmap in certificate"
+    bitmap = int.from_bytes(bytes.fromhex(signers), 'little')
+    return [node_index for node_index in range(bitmap.bit_length()) if bitmap >> node_index & 1]
+
+def certificate_messages(certificate, type, round, value, height):
+    # Rebuilds the signed `type` messages for `value` in `round` that `certificate` was created from
+    signers = certificate_signers(certificate)
+    signatures = certificate['signatures']
+    assert len(signatures) == len(signers), "Certificate needs one signature per signer"
+    return [ConsensusMessage(type, round, {'value': value}, sender, signature, height=height) for sender, signature in zip(signers, signatures)]
+
+
+class VoteTally:
+    # All messages of one type in one round, indexed by sender, with running weights per value
+    def __init__(self):
+        self.messages = {}
+        self.weights = {}
+        self.total_weight = 0
+        self.value_weights = {}
+        self.best_value = None
+        self.best_weight = 0
+
+    def add(self, message: ConsensusMessage, weight: int):
+        if message.sender in self.messages:
+            return False
+        self.messages[message.sender] = message
+        self.weights[message.sender] = weight
+        self.total_weight += weight
+        # Only PREPARE and COMMIT messages carry a `value`
+        value = message.data.get('value')
+        self.value_weights[value] = self.value_weights.get(value, 0) + weight
+        if self.value_weights[value] > self.best_weight:
+            self.best_value = value
+            self.best_weight = self.value_weights[value]
+        return True
+
+    def remove(self, sender):
+        if sender not in self.messages:
+            return
+        value = self.messages.pop(sender).data.get('value')
+        weight = self.weights.pop(sender)
+        self.total_weight -= weight
+        self.value_weights[value] -= weight
+        if self.value_weights[value] == 0:
+            del self.value_weights[value]
+        self.best_value, self.best_weight = max(self.value_weights.items(), key=lambda item: item[1], default=(None, 0))
+
+    def get_messages_with_value(self, value):
+        return [message for message in self.messages.values() if message.data.get('value') == value]
+
 
 class ConsensusStore:
-    def __init__(self, node_id, peers):
+    def __init__(self, node_id, peers, history_rounds=1, future_rounds=16, max_future_rounds_per_sender=4):
+        # Retention, so that memory does not grow with the number of rounds:
+        # - rounds before `round - history_rounds` are pruned, unless they are at or after the prepared round. COMMIT messages are kept.
+        # - messages for rounds after `round + future_rounds` are dropped, only the highest ROUND_CHANGE of each sender is kept
+        # - each sender has messages in at most `max_future_rounds_per_sender` rounds after `round`, its lowest such round is evicted first
+        # - a decided store only keeps its COMMIT quorum
+        self.history_rounds = history_rounds
+        self.future_rounds = future_rounds
+        self.max_future_rounds_per_sender = max_future_rounds_per_sender
         self.node_id = node_id
         self.peers = peers
         self.state = "PRE_PREPARED"
@@ -84,8 +529,15 @@ class ConsensusStore:
         self.prepared_value = None
         self.decided_value = None
         self.leader = 0
-        self.messages = {}
+        # `tallies` maps round -> type -> VoteTally
+        self.tallies = {}
+        # Highest ROUND_CHANGE message from each sender, as sender -> (message, weight)
+        self.highest_round_changes = {}
         self.quorum_messages = {}
+        # The last PRE_PREPARE proposed by this node, so that it proposes the same one again after a restart
+        self.proposal = None
+        # True if the store was restored from disk, see `wal.PersistentConsensusStore`
+        self.recovered = False
 
     def set_state(self, state: str):
         assert state in ["PRE_PREPARED", "PREPARED", "COMMITTED", "DECIDED", "ROUND_TIMEOUT", "ROUND_CHANGED"], "Setting unknown state:"+str(state)
@@ -118,30 +570,112 @@ class ConsensusStore:
     def get_decided_value(self):
         return self.decided_value
 
+    def set_proposal(self, proposal: ConsensusMessage):
+        self.proposal = proposal
+
+    def get_proposal(self):
+        return self.proposal
+
     def set_leader(self, leader: int):
         self.leader = leader
 
     def get_leader(self):
         return self.leader
 
-    def add_message(self, message: ConsensusMessage):
+    def add_message(self, message: ConsensusMessage, weight=1):
+        # `weight` is the weight of the sender, it is added to the tallies of the message's round and type
         round, type, sender = message.round, message.type, message.sender
-        if round not in self.messages:
-            self.messages[round] = {}
-        if type not in self.messages[round]:
-            self.messages[round][type] = []
+        if round > self.round + self.future_rounds:
+            # Too far ahead to be stored. The highest ROUND_CHANGE of each sender still counts towards a round change.
+            if type == "ROUND_CHANGE" and (sender not in self.highest_round_changes or self.highest_round_changes[sender][0].round < round):
+                self.highest_round_changes[sender] = (message, weight)
+                return True
+            return False
+        if not self.is_retained(round, type):
+            return False
+        if round > self.round and not self.make_room_for_future_round(sender, round):
+            return False
+        if round not in self.tallies:
+            self.tallies[round] = {}
+        if type not in self.tallies[round]:
+            self.tallies[round][type] = VoteTally()
         # Insert only one message of each type from each sender for each round
-        if any(existing_message.sender==sender for existing_message in self.messages[round][type]):
+        if not self.tallies[round][type].add(message, weight):
             return False
-        self.messages[round][type].append(message)
+        if type == "ROUND_CHANGE":
+            if sender not in self.highest_round_changes or self.highest_round_changes[sender][0].round < round:
+                self.highest_round_changes[sender] = (message, weight)
         return True
 
+    def is_retained(self, round: int, type=None):
+        # From the prepared round, or `history_rounds` back if that is earlier, to `future_rounds` ahead.
+        # COMMIT messages of all past rounds are kept: a quorum of them still decides, also when peers send it to a node that
+        # fell behind, see `manager.ConsensusManager`.
+        if type == "COMMIT" and round <= self.round:
+            return True
+        first_round = self.round - self.history_rounds
+        if self.prepared_round > 0:
+            first_round = min(first_round, self.prepared_round)
+        return first_round <= round <= self.round + self.future_rounds
 
-    def get_messages(self, round: int, type: str):
-        if round in self.messages and type in self.messages[round]:
-            return self.messages[round][type]
+    def make_room_for_future_round(self, sender, round: int):
+        # Returns False if `sender` already has messages in `max_future_rounds_per_sender` rounds after the current round, all of them higher than `round`
+        future_rounds = sorted(future_round for future_round, tallies in self.tallies.items() if future_round > self.round and any(sender in tally.messages for tally in tallies.values()))
+        if round in future_rounds or len(future_rounds) < self.max_future_rounds_per_sender:
+            return True
+        if future_rounds[0] > round:
+            return False
+        self.remove_sender_messages(future_rounds[0], sender)
+        return True
+
+    def remove_sender_messages(self, round: int, sender):
+        for tally in self.tallies[round].values():
+            if sender in tally.messages:
+                tally.remove(sender)
+
+    def prune(self):
+        # Drops the rounds that are no longer retained
+        for round in list(self.tallies):
+            for type in [type for type in self.tallies[round] if not self.is_retained(round, type)]:
+                del self.tallies[round][type]
+            if not self.tallies[round]:
+                del self.tallies[round]
+        for round in [round for round in self.quorum_messages if not self.is_retained(round)]:
+            del self.quorum_messages[round]
+        for sender in [sender for sender, (message, weight) in self.highest_round_changes.items() if message.round <= self.round]:
+            del self.highest_round_changes[sender]
+
+    def prune_decided(self):
+        # A decided instance rejects all messages, only its COMMIT quorum is kept
+        self.tallies = {}
+        self.highest_round_changes = {}
+        self.quorum_messages = {round: {"COMMIT_QUORUM": quorums["COMMIT_QUORUM"]} for round, quorums in self.quorum_messages.items() if quorums.get("COMMIT_QUORUM")}
+
+    def get_decided_quorum(self):
+        # The COMMIT quorum that decided this store, empty if it is not decided
+        for quorums in self.quorum_messages.values():
+            if quorums.get("COMMIT_QUORUM"):
+                return quorums["COMMIT_QUORUM"]
         return []
 
+    def get_tally(self, round: int, type: str):
+        if round in self.tallies and type in self.tallies[round]:
+            return self.tallies[round][type]
+        return VoteTally()
+
+    def get_messages(self, round: int, type: str):
+        return list(self.get_tally(round, type).messages.values())
+
+    def get_future_round_changes(self, round: int):
+        # Returns the highest ROUND_CHANGE message of each sender that sent one for a round after `round`, and their total weight
+        rc_messages = []
+        supporting_weight = 0
+        for rc_message, weight in self.highest_round_changes.values():
+            if rc_message.round > round:
+                rc_messages.append(rc_message)
+                supporting_weight += weight
+        return rc_messages, supporting_weight
+
     def add_quorum_messages(self, round: int, type: str, messages):
         # type can be PREPARE_QUORUM or COMMIT_QUORUM
         if round not in self.quorum_messages:
@@ -160,14 +694,20 @@ class ConsensusStore:
     def get_peers(self):
         return self.peers
 
+    def sync(self):
+        # Makes all changes to the store durable. The in-memory store has nothing to do.
+        pass
+
+    def close(self):
+        pass
+
 def broadcast_message(msg, peers, timeout=1):
-    # TODO: Move broadcast_message to the networking layer
-    # TODO: POST in an async manner
+    # Serial fallback for when `Consensus` has no broadcaster. See `network.AsyncBroadcaster` for the concurrent version.
     msg_dict = msg.to_dict()
     for peer in peers:
         url = 'http://'+peer+'/messages'
         try:
-            log.info(f'Sending message to {peer}, message: {msg_dict}')
+            message_log.debug('Sending message to %s, message: %s', peer, msg_dict)
             response = httpx.post(url, json=msg_dict, timeout=timeout)
             if response.status_code != 200:
                 log.warn(f'Failed POST to http://{peer}/messages, response status code: {response.status_code}')
@@ -175,7 +715,7 @@ def broadcast_message(msg, peers, timeout=1):
             log.error(f'Failed POST to http://{peer}/messages', exc_info=True)
 
 class Consensus:
-    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None):
+    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None, broadcaster=None, signer=None, height=0, value_store=None, timers=None, timeout_policy=None, leader_schedule=None, verifier=None):
         # `nodes` is a dict that maps node_index -> ConsensusNode
         self.nodes = nodes
         self.byz_quorum = byz_quorum
@@ -188,12 +728,95 @@ class Consensus:
         self.store = store
         # If this node is a participant in consensus, then `node_identity` is the `node_index` corresponding to this node. Else, it is None.
         self.node_identity = node_identity
-        # Node 0 is the first leader
-        self.store.set_leader(0)
-        # Round 1 is the first round
-        self.store.set_round(1)
-        self.store.set_prepared_round(0)
-        self.store.set_state("PRE_PREPARED")
+        # `height` identifies this instance when a `manager.ConsensusManager` runs several instances in one process
+        self.height = height
+        # `broadcaster` sends messages to peers without blocking, e.g. `network.AsyncBroadcaster`. If it is None, messages are sent serially with `broadcast_message`.
+        self.broadcaster = broadcaster
+        # `signer` is a `signing.MessageSigner` for the key of this node. Messages are sent unsigned if it is None.
+        self.signer = signer
+        # `value_store` is a `value_store.ValueStore`. If it is set, only PRE_PREPARE messages carry the proposed value, and
+        # PREPARE, COMMIT and ROUND_CHANGE messages carry its digest. Else all messages carry the full value.
+        self.value_store = value_store
+        # `timers` is a `timers.Timers` that runs the round timer on the thread that processes messages. The round timer is not run if it is None.
+        self.timers = timers
+        self.round_timer = None
+        # `timeout_policy` gives the timeout of each round, see `timeout_policy.py`. Defaults to `round_duration`, doubled every round.
+        self.timeout_policy = timeout_policy if timeout_policy is not None else ExponentialTimeout(round_duration.total_seconds())
+        # Time at which the PRE_PREPARE of the current round was accepted, to observe the PRE_PREPARE -> DECIDED latency
+        self.pre_prepared_at = None
+        # Time at which the current phase (round start, PREPARED, COMMITTED) was entered, for `PHASE_SECONDS`
+        self.phase_started_at = None
+        # Signatures are checked for the nodes in `nodes` that have a public key. `verifier` is a `signing.SignatureVerifier` for `nodes`,
+        # which can be shared by the instances of all heights and a `relay.RelayBroadcaster`, so every message is verified once.
+        self.verifier = verifier if verifier is not None else SignatureVerifier(nodes)
+        # `validated` holds (message digest, round) of messages known to be valid for that round
+        self.validated = OrderedDict()
+        self.validation_cache_size = 65536
+        # `leader_schedule` gives the leader of each (height, round), see `leader_schedule.py`. Defaults to round-robin over `nodes`.
+        self.leader_schedule = leader_schedule if leader_schedule is not None else RoundRobinSchedule(nodes)
+        # Subclasses that defer messages (see `DrandConsensus`) process them later through `reprocess`, which `manager.ConsensusManager`
+        # points to its own `process_message` so that it sees the results
+        self.reprocess = self.process_message
+        if self.store.recovered:
+            # Continue in the round and state from before the restart
+            self.set_round(self.store.get_round())
+            if self.store.get_state() == "DECIDED":
+                self.store.prune_decided()
+        else:
+            # Round 1 is the first round
+            self.set_round(1)
+            self.store.set_prepared_round(0)
+            self.store.set_state("PRE_PREPARED")
+
+    def start(self):
+        # Starts round 1 at the start time of this instance: runs the round timer, and proposes if this node is the leader
+        self.start_timer()
+        self.phase_started_at = self.now()
+        if self.node_identity == self.store.get_leader() and self.store.get_round() == 1 and self.store.get_state() == "PRE_PREPARED":
+            self.broadcast_proposal()
+
+    def set_round(self, round):
+        # Moves to `round`, along with its leader
+        self.store.set_round(round)
+        self.store.set_leader(self.leader_schedule.get_leader(self.height, round))
+        self.store.prune()
+        self.phase_started_at = self.now()
+
+    def end_phase(self, phase):
+        # Observes the duration of the phase that ends with entering `phase`
+        now = self.now()
+        if self.phase_started_at is not None:
+            PHASE_SECONDS.labels(phase).observe(now - self.phase_started_at)
+        self.phase_started_at = now
+
+    def get_round_timeout(self, round):
+        # Timeout (in seconds) of `round`
+        return self.timeout_policy.get_timeout(round)
+
+    def now(self):
+        return self.timers.now() if self.timers is not None else time.time()
+
+    def start_timer(self):
+        # Starts, or restarts, the timer of the current round
+        if self.timers is None:
+            return
+        self.stop_timer()
+        self.round_timer = self.timers.call_later(self.get_round_timeout(self.store.get_round()), self.round_timeout)
+
+    def stop_timer(self):
+        if self.round_timer is not None:
+            self.timers.cancel(self.round_timer)
+            self.round_timer = None
+
+    def broadcast(self, message):
+        # The state that led to `message` must survive a restart before the message is sent
+        self.store.sync()
+        if self.signer is not None and message.sender == self.node_identity and message.siganture == "":
+            message = self.signer.sign(message)
+        if self.broadcaster is None:
+            broadcast_message(message, self.store.get_peers())
+            return None
+        return self.broadcaster.broadcast(message, self.store.get_peers())
 
     def create_proposal(self, value=None, justification=[]):
         round = self.store.get_round()
@@ -205,28 +828,89 @@ class Consensus:
             data['value'] = value
         data['justification'] = justification
         sender = self.node_identity
-        return ConsensusMessage("PRE_PREPARE", round, data, sender)
+        return ConsensusMessage("PRE_PREPARE", round, data, sender, height=self.height)
 
     def broadcast_proposal(self, value=None, justification=[]):
-        broadcast_message(self.create_proposal(value, justification), self.store.get_peers())
+        # A leader that already proposed in this round, before a restart, sends the same proposal again
+        proposal = self.store.get_proposal()
+        if proposal is None or proposal.round != self.store.get_round():
+            proposal = self.create_proposal(value, justification)
+            self.store.set_proposal(proposal)
+        self.broadcast(proposal)
 
     def broadcast_round_change(self):
         round = self.store.get_round()
         data = {}
         data['prepared_value'] = self.store.get_prepared_value()
         data['prepared_round'] = self.store.get_prepared_round()
-        data['justification'] = self.store.get_quorum_messages(data['prepared_round'], "PREPARE_QUORUM")
+        data['certificate'] = None
+        if data['prepared_round'] > 0:
+            data['certificate'] = create_certificate(self.store.get_quorum_messages(data['prepared_round'], "PREPARE_QUORUM"))
         sender = self.node_identity
-        rc_message = ConsensusMessage("ROUND_CHANGE", round, data, sender)
-        broadcast_message(rc_message, self.store.get_peers())
+        rc_message = ConsensusMessage("ROUND_CHANGE", round, data, sender, height=self.height)
+        self.broadcast(rc_message)
 
     def round_timeout(self):
+        self.round_timer = None
+        if self.store.get_state() == "DECIDED":
+            return
         log.info('Round timeout')
         current_round = self.store.get_round()
-        self.store.set_round(current_round + 1)
+        self.set_round(current_round + 1)
         self.store.set_state("ROUND_TIMEOUT")
+        ROUND_CHANGES.labels("timeout").inc()
+        self.start_timer()
         self.broadcast_round_change()
 
+    def value_reference(self, value):
+        # The value that PREPARE, COMMIT and ROUND_CHANGE messages carry for the proposed `value`
+        if self.value_store is None:
+            return value
+        return value_digest(value)
+
+    def store_value(self, data):
+        # Puts the value proposed in a PRE_PREPARE message with `data` in `value_store`
+        self.value_store.put(data['value'])
+
+    def resolve_value(self, reference, callback, node_indices=()):
+        # Calls `callback(value)` with the proposed value for the `reference` carried by PREPARE, COMMIT and ROUND_CHANGE messages,
+        # or with None if it is unknown. Values that this node never received are fetched in the background from the nodes in
+        # `node_indices` first, then from the other nodes, and `callback` then runs on the thread of the timers.
+        if self.value_store is None or reference is None:
+            callback(reference)
+            return
+        node_indices = list(node_indices) + [node_index for node_index in self.nodes if node_index not in node_indices]
+        future = self.value_store.fetch(reference, [node_index for node_index in node_indices if node_index != self.node_identity])
+        if not future.done() and self.timers is None:
+            # Nothing could run the callback later, so this waits for the value instead
+            concurrent.futures.wait([future])
+        if future.done():
+            callback(fetched_value(future))
+            return
+        log.info(f'Fetching value {reference}')
+        future.add_done_callback(lambda future: self.timers.call_soon_threadsafe(lambda: callback(fetched_value(future))))
+
+    def resolve_decided_value(self, callback):
+        # Calls `callback(value)` with the decided value, see `resolve_value`
+        self.resolve_value(self.store.get_decided_value(), callback)
+
+    def repropose(self, round, value, justification):
+        # Proposes the prepared `value`, once resolved, if this node still waits for the proposal of `round`
+        if value is None:
+            log.error('Cannot re-propose the prepared value, neither this node nor the nodes it asked have it')
+            return
+        if self.store.get_round() != round or self.store.get_state() != "PRE_PREPARED":
+            return
+        self.broadcast_proposal(value, justification)
+
+    def validate_vote_data(self, data):
+        # Validates the data of PREPARE and COMMIT messages
+        if self.value_store is None:
+            return self.validate_message_data(data)
+        # The value was validated with the PRE_PREPARE that carried it
+        assert is_value_digest(data['value']), "Incorrect type for value digest"
+        return True
+
     def validate_message_data(self, data):
         # NOTE: Verify the message data according to application-specific logic by checking against local state
         assert type(data['value']) == int, "Incorrect type for message data"
@@ -234,11 +918,10 @@ class Consensus:
 
     def validate_pre_prepare_message(self, message, round):
         # Assert will fail if the message is not well-formed
-        # TODO: Make function to get leader from current round
-        assert message.sender == self.store.get_leader(), "Incorrect sender for PRE_PREPARE message"
+        assert message.sender == self.leader_schedule.get_leader(self.height, message.round), "Incorrect sender for PRE_PREPARE message"
         assert message.round == round, "Incorrect round for PRE_PREPARE message"
         assert message.type == "PRE_PREPARE", "Incorrect message type for PRE_PREPARE message"
-        assert message.verify_signature(), "Incorrect siganture for PRE_PREPARE message"
+        assert self.verifier.is_verified(message), "Incorrect siganture for PRE_PREPARE message"
         assert self.validate_message_data(message.data), "Invalid data for PRE_PREPARE message"
         # FIXME: Shift all this into justify_pre_prepare. Implement that correctly.
         assert self.justify_pre_prepare(message, round), "justify_pre_prepare failed for PRE_PREPARE message"
@@ -247,11 +930,14 @@ class Consensus:
 
     def validate_prepare_message(self, message, round):
         # Assert will fail if the message is not well-formed
+        if self.is_validated(message, round):
+            return True
         assert message.type == "PREPARE", "Incorrect message type for PREPARE message"
         assert message.sender in self.nodes, "Unknown sender for PREPARE message"
         assert message.round == round, "Incorrect round for PREPARE message"
-        assert message.verify_signature(), "Incorrect siganture for PREPARE message"
-        assert self.validate_message_data(message.data), "Invalid data for PREPARE message"
+        assert self.verifier.is_verified(message), "Incorrect siganture for PREPARE message"
+        assert self.validate_vote_data(message.data), "Invalid data for PREPARE message"
+        self.remember_validated(message, round)
         return True
 
 
@@ -260,41 +946,67 @@ class Consensus:
         assert message.type == "COMMIT", "Incorrect message type for COMMIT message"
         assert message.sender in self.nodes, "Unknown sender for COMMIT message"
         assert message.round == round, "Incorrect round for COMMIT message"
-        assert message.verify_signature(), "Incorrect siganture for COMMIT message"
-        assert self.validate_message_data(message.data), "Invalid data for COMMIT message"
+        assert self.verifier.is_verified(message), "Incorrect siganture for COMMIT message"
+        assert self.validate_vote_data(message.data), "Invalid data for COMMIT message"
+        return True
+
+    def validate_certificate(self, certificate, round, value):
+        # Validates a certificate of a PREPARE quorum for `value` in `round`, see `create_certificate`
+        assert isinstance(certificate, dict) and 'signers' in certificate and isinstance(certificate.get('signatures'), (list, tuple)), "Incorrect certificate"
+        # The bitmap cannot be longer than the one of a certificate signed by all nodes
+        assert type(certificate['signers']) == str and len(certificate['signers']) <= 2*bitmap_size(max(self.nodes) + 1), "Signer bitmap of certificate is too long"
+        assert all(type(signature) == str for signature in certificate['signatures']), "Incorrect type for signature in certificate"
+        assert self.validate_vote_data({'value': value}), "Invalid value for certificate"
+        prepare_messages = certificate_messages(certificate, "PREPARE", round, value, self.height)
+        prepare_message_quorum = 0
+        for prepare_message, verified in zip(prepare_messages, self.verifier.verify_batch(prepare_messages)):
+            assert prepare_message.sender in self.nodes, "Unknown signer in certificate"
+            assert verified, "Incorrect siganture in certificate"
+            prepare_message_quorum += self.nodes[prepare_message.sender].weight
+        assert prepare_message_quorum >= self.byz_quorum, "Quorum weight not met by certificate"
         return True
 
-    def validate_round_change_message(self, message, round):
+    def validate_round_change_message(self, message, round, require_certificate=True):
         # Assert will fail if the message is not well-formed
+        # Without `require_certificate`, a prepared ROUND_CHANGE message may leave out its certificate, see `create_justification`
+        if self.is_validated(message, round):
+            return True
         assert message.type == "ROUND_CHANGE", "Incorrect message type for ROUND_CHANGE message"
         assert message.sender in self.nodes, "Unknown sender for ROUND_CHANGE message"
         assert message.round == round, "Incorrect round for ROUND_CHANGE message"
         assert 'prepared_round' in message.data and 'prepared_value' in message.data, "Incorrect data for ROUND_CHANGE message"
         assert type(message.data['prepared_round']) == int, "Incorrect type for prepared_round in ROUND_CHANGE message"
         assert message.data['prepared_round'] >= 0 and message.data['prepared_round'] < message.round, "0 <= prepared_round < round failed for ROUND_CHANGE message"
-        assert message.verify_signature(), "Incorrect siganture for ROUND_CHANGE message"
-        if message.data['prepared_round'] > 0 or message.data['prepared_value'] is not None:
-            # TODO: The two conditions in the IF statement should both happen together, or none at all
-            # Validate the justification of the message
-            justification = [ConsensusMessage.from_dict(p_msg) for p_msg in message.data['justification']]
-            prepare_message_quorum = 0
-            seen_node = [False for node_id in self.nodes]
-            for prepare_message in justification:
-                assert not seen_node[prepare_message.sender], "Second message from same sender in the justification of ROUND_CHANGE message"
-                assert prepare_message.value == message.data['prepared_value'], "Value of prepared message in justification is not prepared value in ROUND_CHANGE message"
-                assert self.validate_prepare_message(prepare_message, message.data['prepared_round']), "validate_prepare_message failed for message in justification of ROUND_CHANGE message"
-                seen_node[prepare_message.sender] = True
-                prepare_message_quorum += self.nodes[prepare_message.sender].weight
-            assert prepare_message_quorum >= self.byz_quorum, "Quorum weight not met by the justification of ROUND_CHANGE message"
+        assert (message.data['prepared_round'] > 0) == (message.data['prepared_value'] is not None), "prepared_round and prepared_value must be set together in ROUND_CHANGE message"
+        assert self.verifier.is_verified(message), "Incorrect siganture for ROUND_CHANGE message"
+        assert message.data['prepared_round'] > 0 or message.data.get('certificate') is None, "Certificate in ROUND_CHANGE message that did not prepare"
+        assert len(message.data.get('justification', ())) == 0, "ROUND_CHANGE message must prove its prepared value with a certificate"
+        if message.data['prepared_round'] > 0:
+            if message.data.get('certificate') is None:
+                assert not require_certificate, "Missing certificate in prepared ROUND_CHANGE message"
+                # Not remembered as validated, since it is only valid without a certificate inside a justification
+                return True
+            # Validate the PREPARE quorum of the prepared value
+            assert self.validate_certificate(message.data['certificate'], message.data['prepared_round'], message.data['prepared_value']), "Invalid certificate in ROUND_CHANGE message"
+        self.remember_validated(message, round)
         return True
 
+    def is_validated(self, message, round):
+        # Messages that are already valid for `round` are not validated again when they show up in another justification
+        return (message.digest(), round) in self.validated
+
+    def remember_validated(self, message, round):
+        self.validated[(message.digest(), round)] = True
+        while len(self.validated) > self.validation_cache_size:
+            self.validated.popitem(last=False)
+
     def justify_round_change(self, q_rc, round):
         rc_message_quorum = 0
-        seen_node = [False for node_id in self.nodes]
+        seen_node = set()
         for rc_message in q_rc:
-            assert not seen_node[rc_message.sender], "Second message from same sender in a quorum of ROUND_CHANGE messages"
             assert self.validate_round_change_message(rc_message, round), "ROUND_CHANGE message in quorum is not valid"
-            seen_node[rc_message.sender] = True
+            assert rc_message.sender not in seen_node, "Second message from same sender in a quorum of ROUND_CHANGE messages"
+            seen_node.add(rc_message.sender)
             rc_message_quorum += self.nodes[rc_message.sender].weight
         if rc_message_quorum < self.byz_quorum:
             return False
@@ -306,45 +1018,52 @@ class Consensus:
         if message.round > 1:
             justification = message.data['justification']
             rc_message_quorum = 0
-            rc_seen_node = [False for node_id in self.nodes]
+            rc_seen_node = set()
             for rc_message in justification:
                 # validate_round_change_message will also check that the rc_message is from round `message.round`
-                assert not rc_seen_node[rc_message.sender], "Second ROUND_CHANGE message from same sender in the justification of PRE_PREPARE message"
-                assert self.validate_round_change_message(rc_message, message.round), "ROUND_CHANGE message in justification of PRE_PREPARE is not valid"
-                rc_seen_node[rc_message.sender] = True
+                # ROUND_CHANGE messages that were already validated on arrival are not validated again
+                assert self.validate_round_change_message(rc_message, message.round, require_certificate=False), "ROUND_CHANGE message in justification of PRE_PREPARE is not valid"
+                assert rc_message.sender not in rc_seen_node, "Second ROUND_CHANGE message from same sender in the justification of PRE_PREPARE message"
+                rc_seen_node.add(rc_message.sender)
                 rc_message_quorum += self.nodes[rc_message.sender].weight
             assert rc_message_quorum >= self.byz_quorum, "Justification of PRE_PREPARE message does not satisfy the Byazntine threshold"
 
             highest_pr_rc_message = max(justification, key=lambda rc_msg: rc_msg.data['prepared_round'])
-            if highest_pr_rc_message.data['prepared_round'] > 0 or highest_pr_rc_message.data['prepared_value'] is not None:
-                # TODO: The two conditions in the IF statement should both happen together, or none at all
-                p_message_quorum = 0
-                p_seen_node = [False for node_id in self.nodes]
-                for p_msg in highest_pr_rc_message.data['justification']:
-                    assert not p_seen_node[p_msg.sender], "Second PREPARE message from same sender in the justification of highest_pr_rc_message"
-                    assert p_msg.data['value'] == highest_pr_rc_message.data['value'], "PREPARE message in justification of highest_pr_rc_message does not have highest_pr_rc_message.data['value']"
-                    assert self.validate_prepare_message(p_msg, highest_pr_rc_message.round), "PREPARE message in justification of highest_pr_rc_message is not from highest_pr_rc_message.round"
-                    p_seen_node[p_msg.sender] = True
-                    p_message_quorum += self.nodes[p_msg.sender].weight
-                assert p_message_quorum >= self.byz_quorum, "Justification of highest_pr_rc_message does not meet quorum weight"
+            if highest_pr_rc_message.data['prepared_round'] > 0:
+                # Only highest_pr_rc_message has to prove its prepared value. Its certificate was checked by validate_round_change_message.
+                assert highest_pr_rc_message.data.get('certificate') is not None, "Missing certificate of highest_pr_rc_message in the justification of PRE_PREPARE message"
+                assert self.value_reference(message.data['value']) == highest_pr_rc_message.data['prepared_value'], "PRE_PREPARE message does not propose the prepared value of highest_pr_rc_message"
         return True
 
+    def create_justification(self, rc_quorum):
+        # The justification of a PRE_PREPARE message: a quorum of ROUND_CHANGE messages in which only the one with the highest
+        # prepared round keeps its certificate, so the justification holds O(N) signatures instead of O(N²)
+        highest_pr_rc_message = max(rc_quorum, key=lambda rc_msg: rc_msg.data['prepared_round'])
+        keep = highest_pr_rc_message if highest_pr_rc_message.data['prepared_round'] > 0 else None
+        return [rc_message if rc_message is keep else rc_message.without_certificate() for rc_message in rc_quorum]
+
     def receive_message(self, message, round):
         # TODO: Verify signatures
         if message.type == "PRE_PREPARE":
             if self.validate_pre_prepare_message(message, round):
-                return self.store.add_message(message)
+                return self.store.add_message(message, self.nodes[message.sender].weight)
         elif message.type == "PREPARE":
             if self.validate_prepare_message(message, round):
-                return self.store.add_message(message)
+                return self.store.add_message(message, self.nodes[message.sender].weight)
         elif message.type == "COMMIT":
             if self.validate_commit_message(message, round):
-                return self.store.add_message(message)
+                return self.store.add_message(message, self.nodes[message.sender].weight)
         elif message.type == "ROUND_CHANGE":
             if self.validate_round_change_message(message, round):
-                return self.store.add_message(message)
+                return self.store.add_message(message, self.nodes[message.sender].weight)
         return False
 
+    def process_messages(self, messages):
+        # Verifies the signatures of all `messages` (and their justifications) together, then processes them in order
+        # Returns the result of `process_message` for each message
+        self.verifier.verify_batch(messages)
+        return [self.process_message(message) for message in messages]
+
     def process_message(self, message):
         """
         Returns:
@@ -358,13 +1077,17 @@ class Consensus:
         """
         current_round = self.store.get_round()
         current_state = self.store.get_state()
-        log.info(f'Processing message in round: {current_round},  state: {current_state}')
+        message_log.debug('Processing message in round: %s,  state: %s', current_round, current_state)
         # FIXME: After round change, check if any upon conditions are already satisfied in the store
 
         if message.type not in ["PRE_PREPARE", "PREPARE", "COMMIT", "ROUND_CHANGE"]:
             log.error(f'Unknown message type: {message.type}')
             return "MESSAGE_REJECTED"
 
+        if message.height != self.height:
+            log.error(f'Message for height {message.height} sent to instance of height {self.height}')
+            return "MESSAGE_REJECTED"
+
         if current_state == "DECIDED":
             # TODO: Send the decided value if ROUND_CHANGE message is received
             return "MESSAGE_REJECTED"
@@ -375,9 +1098,12 @@ class Consensus:
 
         try:
             # Validate the message, then add to the store
-            is_new_message = self.receive_message(message, current_round)
+            # Messages are validated for their own round, so that messages of future rounds (and COMMIT messages of past rounds)
+            # are kept, within the retention of the store, instead of being rejected as invalid
+            is_new_message = self.receive_message(message, message.round)
         except AssertionError as e:
-            log.error('Message was invalid', exc_info=True)
+            # The assertion message says what was wrong, the traceback is only formatted for debugging
+            log.error('Message was invalid: %s', e, exc_info=log.isEnabledFor(logging.DEBUG))
             return "MESSAGE_REJECTED"
 
         if not is_new_message:
@@ -385,18 +1111,24 @@ class Consensus:
 
         #-----------------------------------------------------------------------
         if message.type == "PRE_PREPARE":
+            if self.value_store is not None:
+                # Kept to re-propose or decide the value by its digest, and to serve it to nodes that did not receive it
+                self.store_value(message.data)
             if message.round > current_round:
                 return "FUTURE_MESSAGE"
             if current_state not in ["PRE_PREPARED", "ROUND_TIMEOUT", "ROUND_CHANGED"]:
                 return "MSG_NOT_PROCESSED"
             self.store.set_state("PREPARED")
+            self.pre_prepared_at = self.now()
+            self.end_phase("prepared")
             if self.node_identity is not None:
-                data = {'value': message.data['value']}
+                data = {'value': self.value_reference(message.data['value'])}
                 sender = self.node_identity
-                prepare_message = ConsensusMessage("PREPARE", current_round, data, sender)
-                broadcast_message(prepare_message, self.store.get_peers())
-            log.info(f'State set to PREPARED. Prepared for value: {message.data["value"]}')
-            log.debug(f'PRE_PREPARE was: {message}')
+                prepare_message = ConsensusMessage("PREPARE", current_round, data, sender, height=self.height)
+                self.broadcast(prepare_message)
+            log.info('State set to PREPARED. Prepared for value: %s', message.data['value'])
+            log.debug('PRE_PREPARE was: %s', message)
+            self.start_timer()
             return "START_TIMER"
         #-----------------------------------------------------------------------
         elif message.type == "PREPARE":
@@ -404,94 +1136,74 @@ class Consensus:
                 return "FUTURE_MESSAGE"
             if current_state not in ["PRE_PREPARED", "PREPARED", "ROUND_TIMEOUT", "ROUND_CHANGED"]:
                 return "MSG_NOT_PROCESSED"
-            prepare_msgs = self.store.get_messages(current_round, "PREPARE")
-            supporting_weights = {}
-            for msg in prepare_msgs:
-                value = msg.data['value']
-                if value not in supporting_weights:
-                    supporting_weights[value] = 0
-                supporting_weights[value] += self.nodes[msg.sender].weight
-            max_supporting_weight = max(supporting_weights.values())
-            for value in supporting_weights:
-                if supporting_weights[value] == max_supporting_weight:
-                    best_value = value
-            if max_supporting_weight >= self.byz_quorum:
+            prepare_tally = self.store.get_tally(current_round, "PREPARE")
+            best_value = prepare_tally.best_value
+            if prepare_tally.best_weight >= self.byz_quorum:
                 self.store.set_prepared_round(current_round)
                 self.store.set_prepared_value(best_value)
-                quorum_messages = []
-                for msg in prepare_msgs:
-                    if msg.data['value'] == best_value:
-                        quorum_messages.append(msg)
+                quorum_messages = prepare_tally.get_messages_with_value(best_value)
                 self.store.add_quorum_messages(current_round, "PREPARE_QUORUM", quorum_messages)
                 self.store.set_state("COMMITTED")
+                self.end_phase("committed")
                 if self.node_identity is not None:
                     data = {'value': best_value}
                     sender = self.node_identity
-                    commit_message = ConsensusMessage("COMMIT", current_round, data, sender)
-                    broadcast_message(commit_message, self.store.get_peers())
-                log.info(f'State set to COMITTED. Committed to value {best_value}')
-                log.debug(f'PREPARE_QUORUM was: {[msg.to_string() for msg in quorum_messages]}')
+                    commit_message = ConsensusMessage("COMMIT", current_round, data, sender, height=self.height)
+                    self.broadcast(commit_message)
+                log.info('State set to COMITTED. Committed to value %s', best_value)
+                log.debug('PREPARE_QUORUM was: %s', Lazy(lambda: [msg.to_string() for msg in quorum_messages]))
             return "NO_CHANGE"
         #-----------------------------------------------------------------------
         elif message.type == "COMMIT":
             if current_state not in ["PRE_PREPARED", "PREPARED", "COMMITTED", "ROUND_TIMEOUT", "ROUND_CHANGED"]:
                 # Process commit messages in any state
                 return "MSG_NOT_PROCESSED"
-            commit_msgs = self.store.get_messages(message.round, "COMMIT")
-            supporting_weights = {}
-            for msg in commit_msgs:
-                value = msg.data['value']
-                if value not in supporting_weights:
-                    supporting_weights[value] = 0
-                supporting_weights[value] += self.nodes[msg.sender].weight
-            max_supporting_weight = max(supporting_weights.values())
-            for value in supporting_weights:
-                if supporting_weights[value] == max_supporting_weight:
-                    best_value = value
-            if max_supporting_weight >= self.byz_quorum:
+            commit_tally = self.store.get_tally(message.round, "COMMIT")
+            best_value = commit_tally.best_value
+            if commit_tally.best_weight >= self.byz_quorum:
                 self.store.set_decided_value(best_value)
-                quorum_messages = []
-                for msg in commit_msgs:
-                    if msg.data['value'] == best_value:
-                        quorum_messages.append(msg)
+                quorum_messages = commit_tally.get_messages_with_value(best_value)
                 self.store.add_quorum_messages(message.round, "COMMIT_QUORUM", quorum_messages)
                 self.store.set_state("DECIDED")
-                log.info(f'State set to DECIDED. Decided on value: {best_value}')
-                log.debug(f'COMMIT_QUORUM was: {[msg.to_string() for msg in quorum_messages]}')
+                self.end_phase("decided")
+                self.store.prune_decided()
+                self.store.sync()
+                log.info('State set to DECIDED. Decided on value: %s', best_value)
+                log.debug('COMMIT_QUORUM was: %s', Lazy(lambda: [msg.to_string() for msg in quorum_messages]))
+                self.stop_timer()
+                if self.pre_prepared_at is not None and message.round == current_round:
+                    self.timeout_policy.observe(self.now() - self.pre_prepared_at)
                 return "STOP_TIMER"
             return "NO_CHANGE"
         #-----------------------------------------------------------------------
         elif message.type == "ROUND_CHANGE":
             if current_state != "ROUND_CHANGED" and message.round > current_round:
-                rc_quorum = []
-                seen_node = [False for node in self.nodes]
-                supporting_weight = 0
-                # TODO: Don't access self.store.messages directly
-                for round in self.store.messages:
-                    if round > current_round:
-                        if "ROUND_CHANGE" in self.store.messages[round]:
-                            for rc_msg in self.store.messages[round]["ROUND_CHANGE"]:
-                                if not seen_node[rc_msg.sender]:
-                                    rc_quorum.append(rc_msg)
-                                    seen_node[rc_msg.sender] = True
-                                    supporting_weight += self.nodes[rc_msg.sender].weight
+                rc_quorum, supporting_weight = self.store.get_future_round_changes(current_round)
                 if supporting_weight >= self.rc_threshold:
                     rc_quorum_round_nums = [rc_msg.round for rc_msg in rc_quorum]
                     new_round_num = min(rc_quorum_round_nums)
-                    self.store.set_round(new_round_num)
+                    self.set_round(new_round_num)
                     self.store.set_state("ROUND_CHANGED")
+                    ROUND_CHANGES.labels("round_change").inc()
+                    self.start_timer()
                     self.broadcast_round_change()
-                    log.info(f'State set to ROUND_CHANGED. rc_quorum was: {[msg.to_string() for msg in rc_quorum]}')
+                    log.info('State set to ROUND_CHANGED. rc_quorum was: %s', Lazy(lambda: [msg.to_string() for msg in rc_quorum]))
                     return "START_TIMER"
             elif message.round == current_round:
-                rc_quorum = self.store.get_messages(current_round, "ROUND_CHANGE")
-                supporting_weight = sum([self.nodes[rc_msg.sender].weight for rc_msg in rc_quorum])
-                # TODO: Don't access self.store.messages directly
-                if supporting_weight >= self.byz_quorum:
+                rc_tally = self.store.get_tally(current_round, "ROUND_CHANGE")
+                if rc_tally.total_weight >= self.byz_quorum:
+                    rc_quorum = list(rc_tally.messages.values())
                     highest_pr_rc_message = max(rc_quorum, key=lambda rc_msg: rc_msg.data['prepared_round'])
                     self.store.set_state("PRE_PREPARED")
                     if self.store.get_leader() == self.node_identity:
-                        self.broadcast_proposal(highest_pr_rc_message.data['prepared_value'], rc_quorum)
+                        prepared_value = highest_pr_rc_message.data['prepared_value']
+                        justification = self.create_justification(rc_quorum)
+                        if prepared_value is None:
+                            self.broadcast_proposal(None, justification)
+                        else:
+                            # The senders of the PREPARE quorum have the value
+                            signers = certificate_signers(highest_pr_rc_message.data['certificate'])
+                            self.resolve_value(prepared_value, lambda value: self.repropose(current_round, value, justification), signers)
             return "NO_CHANGE"
         #-----------------------------------------------------------------------
         log.error(f'Unknown message type: {message.type}')
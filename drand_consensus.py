@@ -1,39 +1,21 @@
-from consensus import Consensus, ConsensusMessage
-import httpx
+from fetched_consensus import FetchedValueConsensus
 import logging
 
 log = logging.getLogger(__name__)
 
-class DrandConsensus(Consensus):
-    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None, drand_api='https://drand.cloudflare.com/public', drand_round=1):
-        self.drand_api = drand_api
+class DrandConsensus(FetchedValueConsensus):
+    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None, broadcaster=None, signer=None, height=0, value_store=None, timers=None, timeout_policy=None, leader_schedule=None, verifier=None, drand_round=1, drand_source=None):
+        # `drand_source` is a `value_source.DrandSource`, shared by the instances of all heights and closed by its owner.
+        # It is required: a source per instance would leave a fetch thread behind for every height.
+        assert drand_source is not None, "DrandConsensus requires a drand_source"
         self.drand_round = drand_round
-        url = self.drand_api+'/'+str(self.drand_round)
-        try:
-            response = httpx.get(url, timeout=2)
-            if response.status_code != 200:
-                log.warn(f'Failed GET from {url}, response status code: {response.status_code}')
-            response_json = response.json()
-            self.drand_value = response_json['randomness']
-        except:
-            log.error(f'drand request to {url} failed', exc_info=True)
+        self.drand_source = drand_source
+        # The rounds of the next heights are fetched ahead
+        value_future = self.drand_source.get(self.drand_round)
+        self.drand_source.prefetch(self.drand_round + 1)
 
-        super().__init__(nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=node_identity)
+        super().__init__(nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=node_identity, broadcaster=broadcaster, signer=signer, height=height, value_store=value_store, timers=timers, timeout_policy=timeout_policy, leader_schedule=leader_schedule, verifier=verifier, value_future=value_future, value_name=f'drand round {drand_round}')
 
     def get_drand_value(self):
-        return self.drand_value
-
-    def create_proposal(self, value=None, justification=[]):
-        round = self.store.get_round()
-        data = {}
-        if value is None:
-            data['value'] = self.get_drand_value()
-        else:
-            data['value'] = value
-        data['justification'] = justification
-        sender = self.node_identity
-        return ConsensusMessage("PRE_PREPARE", round, data, sender)
-
-    def validate_message_data(self, data):
-        assert type(data['value']) == str, "Incorrect type for message data"
-        return data['value'] == self.get_drand_value()
+        # Returns None if the drand value is not fetched yet
+        return self.get_fetched_value()
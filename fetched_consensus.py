@@ -0,0 +1,84 @@
+import concurrent.futures
+from consensus import Consensus, ConsensusMessage
+import logging
+
+log = logging.getLogger(__name__)
+
+class FetchedValueConsensus(Consensus):
+    def __init__(self, nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=None, broadcaster=None, signer=None, height=0, value_store=None, timers=None, timeout_policy=None, leader_schedule=None, verifier=None, value_future=None, value_name='value'):
+        # Forms consensus on a value that every node fetches from an external source, see `value_source.py`
+        # `value_future` is the concurrent.futures.Future of the value, fetched in the background so that the thread that
+        # processes messages never waits on the source. `value_name` describes the value in logs.
+        assert value_future is not None, "FetchedValueConsensus requires a value_future"
+        self.value_future = value_future
+        self.value_name = value_name
+        # Messages that arrive before the value, processed again once it is fetched
+        self.deferred_messages = []
+        self.max_deferred_messages = 4096
+
+        super().__init__(nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=node_identity, broadcaster=broadcaster, signer=signer, height=height, value_store=value_store, timers=timers, timeout_policy=timeout_policy, leader_schedule=leader_schedule, verifier=verifier)
+
+    def get_fetched_value(self):
+        # Returns None if the value is not fetched yet
+        if self.timers is None:
+            # Nothing could process the messages that wait for the value, so this waits for it instead
+            concurrent.futures.wait([self.value_future])
+        if not self.value_future.done() or self.value_future.cancelled() or self.value_future.exception() is not None:
+            return None
+        return self.value_future.result()
+
+    def when_fetched(self, callback):
+        # Runs `callback()` on the thread of the timers once the value is fetched
+        self.value_future.add_done_callback(lambda future: self.timers.call_soon_threadsafe(callback))
+
+    def broadcast_proposal(self, value=None, justification=[]):
+        if value is None and self.get_fetched_value() is None:
+            # The leader proposes once the value is fetched, if it is still in the same round
+            round = self.store.get_round()
+            def propose():
+                if self.store.get_round() == round and self.store.get_state() != "DECIDED" and self.get_fetched_value() is not None:
+                    self.broadcast_proposal(value, justification)
+            log.info(f'Waiting for {self.value_name} to propose')
+            self.when_fetched(propose)
+            return
+        super().broadcast_proposal(value, justification)
+
+    def process_message(self, message):
+        # Every message may carry the value (in PREPARE, COMMIT and certificates without value digests), so messages
+        # wait until this node has it instead of being rejected as invalid. Returns "DEFERRED" for those.
+        if self.get_fetched_value() is not None or message.height != self.height:
+            return super().process_message(message)
+        if len(self.deferred_messages) >= self.max_deferred_messages:
+            log.warning(f'Dropping message, {len(self.deferred_messages)} messages are already waiting for {self.value_name}')
+            return "MESSAGE_REJECTED"
+        self.deferred_messages.append(message)
+        if len(self.deferred_messages) == 1:
+            self.when_fetched(self.process_deferred_messages)
+        return "DEFERRED"
+
+    def process_deferred_messages(self):
+        if self.get_fetched_value() is None:
+            # The fetch was cancelled, the messages cannot be validated
+            log.error(f'{self.value_name} is not available, dropping {len(self.deferred_messages)} messages')
+            self.deferred_messages = []
+            return
+        messages, self.deferred_messages = self.deferred_messages, []
+        for message in messages:
+            self.reprocess(message)
+
+    def create_proposal(self, value=None, justification=[]):
+        round = self.store.get_round()
+        data = {}
+        if value is None:
+            data['value'] = self.get_fetched_value()
+        else:
+            data['value'] = value
+        data['justification'] = justification
+        sender = self.node_identity
+        return ConsensusMessage("PRE_PREPARE", round, data, sender, height=self.height)
+
+    def validate_message_data(self, data):
+        assert type(data['value']) == str, "Incorrect type for message data"
+        fetched_value = self.get_fetched_value()
+        assert fetched_value is not None, f"{self.value_name} is not available"
+        return data['value'] == fetched_value
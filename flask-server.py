@@ -1,9 +1,8 @@
 import argparse
-import math
-import datetime
-import pika
-import json
-from consensus import ConsensusMessage
+import atexit
+from broker import RabbitMQPublisher, queue_name
+from consensus import JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE
+from metrics import REGISTRY, CONTENT_TYPE, Gauge
 from flask import Flask, request
 import logging
 
@@ -38,21 +37,28 @@ node_identity = args.node_identity
 if node_identity < 0:
     node_identity = None
 
+publisher = RabbitMQPublisher(queue_name(node_identity))
+atexit.register(lambda: publisher.close())
+Gauge('ingress_queue_depth', 'Received messages waiting to be published to RabbitMQ').set_function(lambda: publisher.pending.qsize())
+
 app = Flask(__name__)
 
 @app.route('/messages', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        log.debug(f'Received message: {request.json}')
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='localhost'))
-        channel = connection.channel()
-        channel.queue_declare(queue='ibft_node_'+str(node_identity))
-        channel.basic_publish(exchange='', routing_key='ibft_node_'+str(node_identity), body=json.dumps(request.json))
-        connection.close()
+        if request.mimetype not in [JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE]:
+            return "Unsupported message format", 415
+        # Forward the raw request body, the worker parses it
+        body = request.get_data()
+        log.debug(f'Received message: {body}')
+        publisher.publish(body)
         return "POST received"
     elif request.method == 'GET':
         return "Hello from Flask!"
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return REGISTRY.expose(), 200, {'Content-Type': CONTENT_TYPE}
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=args.port, use_reloader=False, threaded=True)
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import atexit
+import queue
+from broker import RabbitMQPublisher, queue_name
+from consensus import JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE
+from network import HTTPListener
+from metrics import REGISTRY, Counter, Gauge
+import logging
+
+# python3 ingress-server.py --node_identity 0 --port 9000
+# Receives messages over HTTP on an asyncio event loop and publishes them to the RabbitMQ queue of the node, in place of flask-server.py.
+# A POST to /messages carries one message or a batch of messages (a JSON array or a binary batch frame), which is published as is:
+# the worker decodes it. Bodies wait in a bounded queue for the publisher thread. When it is full, requests wait for room up to
+# --queue_timeout seconds, which slows down senders, then get 503. Bodies over --max_body_size bytes get 413.
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--node_identity",
+    type = int,
+    default = -1,
+    help = "Node index corresponding to this node"
+)
+parser.add_argument(
+    "--host",
+    type = str,
+    default = "0.0.0.0",
+    help = "Host on which to listen"
+)
+parser.add_argument(
+    "--port",
+    type = int,
+    default = 9000,
+    help = "Port on which to listen"
+)
+parser.add_argument(
+    "--queue_size",
+    type = int,
+    default = 10000,
+    help = "Maximum number of received bodies waiting to be published to RabbitMQ"
+)
+parser.add_argument(
+    "--queue_timeout",
+    type = float,
+    default = 1,
+    help = "Time (in seconds) that a request waits for room in a full queue before it is rejected with 503"
+)
+parser.add_argument(
+    "--max_body_size",
+    type = int,
+    default = 16*1024*1024,
+    help = "Maximum size (in bytes) of a request body. Larger requests are rejected with 413"
+)
+args = parser.parse_args()
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(f'%(asctime)s - %(name)s - %(levelname)8s - Node:{args.node_identity} - %(message)s')
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+node_identity = args.node_identity
+if node_identity < 0:
+    node_identity = None
+
+publisher = RabbitMQPublisher(queue_name(node_identity), max_pending=args.queue_size)
+atexit.register(lambda: publisher.close())
+
+REQUESTS = Counter('ingress_requests_total', 'POST /messages requests, by result', ['result'])
+Gauge('ingress_queue_depth', 'Received bodies waiting to be published to RabbitMQ').set_function(lambda: publisher.pending.qsize())
+
+async def post_messages(path, headers, body):
+    if headers.get('content-type', JSON_CONTENT_TYPE).split(';')[0].strip() not in [JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE]:
+        REQUESTS.labels("unsupported").inc()
+        return 415, 'text/plain', b'Unsupported message format'
+    try:
+        publisher.publish(body, block=False)
+    except queue.Full:
+        # Wait for room on a worker thread, so the event loop keeps serving the other connections
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, publisher.publish, body, True, args.queue_timeout)
+        except queue.Full:
+            log.warning(f'Queue is full, rejecting a body of {len(body)} bytes')
+            REQUESTS.labels("rejected").inc()
+            return 503, 'text/plain', b'Queue is full'
+    REQUESTS.labels("accepted").inc()
+    return 200, 'text/plain', b'POST received'
+
+def get_messages(path, headers, body):
+    return 200, 'text/plain', b'Hello from the ingress server!'
+
+async def serve():
+    listener = HTTPListener(max_body_size=args.max_body_size)
+    listener.add_route('POST', '/messages', post_messages)
+    listener.add_route('GET', '/messages', get_messages)
+    listener.add_route('GET', '/metrics', REGISTRY.handle_get)
+    await listener.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await listener.stop()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        log.info('Interrupted')
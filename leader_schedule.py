@@ -0,0 +1,35 @@
+import math
+from functools import reduce
+
+# Leader of each (height, round). The leaders of one period are precomputed into `table`, which repeats,
+# so that looking up a leader is a single index. Round r of height h is led by table[(h + r - 1) % len(table)],
+# so the first leader also rotates across heights.
+
+class RoundRobinSchedule:
+    def __init__(self, nodes):
+        # `nodes` is a dict that maps node_index -> ConsensusNode
+        self.table = sorted(nodes)
+
+    def get_leader(self, height, round):
+        return self.table[(height + round - 1) % len(self.table)]
+
+class WeightedSchedule(RoundRobinSchedule):
+    def __init__(self, nodes, max_period=4096):
+        # Every node leads a share of the rounds proportional to its weight, interleaved as evenly as possible (smooth weighted round-robin)
+        # Weights are divided by their GCD. If the period is still longer than `max_period`, they are scaled down, keeping every node at least once.
+        weights = {node_index: node.weight for node_index, node in nodes.items() if node.weight > 0}
+        assert weights, "At least one node must have a positive weight"
+        divisor = reduce(math.gcd, weights.values())
+        weights = {node_index: weight // divisor for node_index, weight in weights.items()}
+        total = sum(weights.values())
+        if total > max_period:
+            weights = {node_index: max(1, weight * max_period // total) for node_index, weight in weights.items()}
+            total = sum(weights.values())
+        current = {node_index: 0 for node_index in weights}
+        self.table = []
+        for i in range(total):
+            for node_index in sorted(weights):
+                current[node_index] += weights[node_index]
+            leader = max(sorted(weights), key=lambda node_index: current[node_index])
+            current[leader] -= total
+            self.table.append(leader)
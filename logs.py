@@ -0,0 +1,72 @@
+import atexit
+import queue
+import logging
+import logging.handlers
+
+# Logging helpers for the hot path, where a log line is written for every message
+# Log calls pass their arguments %-style instead of as f-strings, so nothing is formatted unless a handler emits the record.
+
+class Lazy:
+    # An argument of a log call that is only computed when the record is formatted, e.g. Lazy(lambda: [m.to_string() for m in quorum])
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+    __repr__ = __str__
+
+class SampledLog:
+    # Only emits one in `every` of its log calls that pass the level of `logger`, for logs of every received or sent message
+    # `every` is shared by all sampled logs, see `set_sampling`
+    every = 1
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.count = 0
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        self.count += 1
+        if self.count >= SampledLog.every:
+            self.count = 0
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+def set_sampling(every):
+    assert every >= 1, "Sampling must keep at least one in every `every` records"
+    SampledLog.every = every
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Unlike `QueueHandler`, does not format records before queueing them, so formatting happens on the listener thread as well
+    # Log arguments are read from another thread, which is safe for the immutable messages and values that are logged
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def start_queue_logging(*handlers, max_size=65536):
+    # Returns a handler that queues records for `handlers`, which format and write them on a background thread
+    # When more than `max_size` records are waiting, new records are dropped instead of blocking the hot path
+    records = queue.Queue(max_size)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # Writes the records that are still queued at exit
+    atexit.register(listener.stop)
+    return DeferredQueueHandler(records)
@@ -0,0 +1,200 @@
+import time
+from metrics import Counter, Gauge, Histogram
+import logging
+
+log = logging.getLogger(__name__)
+
+MESSAGES = Counter('consensus_messages_total', 'Received messages, by type and result of process_message', ['type', 'result'])
+PROCESS_SECONDS = Histogram('consensus_process_message_seconds', 'Time spent in process_message, by message type', ['type'])
+HEIGHT = Gauge('consensus_height', 'Lowest height that is not decided yet')
+DECIDED_HEIGHTS = Counter('consensus_decided_heights_total', 'Decided heights')
+INSTANCES = Gauge('consensus_instances', 'Consensus instances in memory')
+
+class ConsensusManager:
+    def __init__(self, create_instance, timers, first_height=0, num_heights=1, window=4, retention=16, on_decided=None, pipeline_depth=1, send=None, verifier=None, on_expired=None):
+        # Runs one `Consensus` instance per height over a shared transport and timer service
+        # `create_instance` is called as create_instance(height) and returns a new `Consensus` for that height, which runs its round timer on `timers`
+        # `timers` is the `timers.Timers` that starts heights at their start time
+        # Heights `first_height` ... `first_height + num_heights - 1` are decided. `num_heights` can be None to keep going forever.
+        # Instances are created for messages up to `window` heights ahead of the lowest undecided height
+        # The decided values of the last `retention` heights are kept, older instances are garbage-collected once decided
+        # `on_decided` is called as on_decided(height, value) for every decided height, in height order
+        # Up to `pipeline_depth` heights run at the same time: height h+1 starts as soon as height h is COMMITTED (has a PREPARE quorum)
+        # instead of waiting for h to be decided. With a depth of 1, heights run strictly one after the other.
+        # A node that missed the COMMIT quorum of a height keeps sending ROUND_CHANGE messages for it. Such a message for one of the
+        # last `retention` decided heights is answered with the COMMIT quorum of the height through `send`, called as
+        # send(messages, node_index), once its signature was checked with `verifier` (a `signing.SignatureVerifier`).
+        # Nodes do not help others catch up if `send` is None.
+        # `on_expired` is called as on_expired(height) once a decided height falls out of the last `retention` decided heights,
+        # after its value was passed to `on_decided` and its instance was closed, e.g. to delete its write-ahead log
+        assert 1 <= pipeline_depth <= window, "pipeline_depth must be between 1 and window"
+        assert retention >= window, "retention must be at least window"
+        assert send is None or verifier is not None, "Sending COMMIT quorums requires a verifier"
+        self.create_instance = create_instance
+        self.timers = timers
+        self.first_height = first_height
+        self.num_heights = num_heights
+        self.window = window
+        self.retention = retention
+        self.on_decided = on_decided
+        self.pipeline_depth = pipeline_depth
+        self.send = send
+        self.verifier = verifier
+        self.on_expired = on_expired
+        # `commit_quorums` maps decided height -> the COMMIT messages that decided it
+        self.commit_quorums = {}
+        # `answered_rounds` maps (height, node_index) -> round of the last ROUND_CHANGE of that node answered with the COMMIT quorum
+        self.answered_rounds = {}
+        # Heights whose timer and leader proposal were started by `start_height`
+        self.started = set()
+        self.instances = {}
+        self.decided_values = {}
+        # The lowest height that is not decided yet
+        self.current_height = first_height
+        HEIGHT.set(first_height)
+
+    def get_instance(self, height):
+        # Creates instances lazily, returns None for heights outside of the window or that were already decided
+        if height in self.instances:
+            return self.instances[height]
+        if height < self.current_height or height >= self.current_height + self.window:
+            return None
+        if self.num_heights is not None and height >= self.first_height + self.num_heights:
+            return None
+        log.info(f'Creating consensus instance for height {height}')
+        instance = self.create_instance(height)
+        instance.reprocess = self.process_message
+        self.instances[height] = instance
+        INSTANCES.set(len(self.instances))
+        # Instances created for an early message of a height also time out, `start_height` restarts the timer
+        instance.start_timer()
+        return instance
+
+    def start_height(self, height, start_time=None):
+        # Starts `height` at `start_time` (a datetime.datetime), or right away if it is None, see `Consensus.start`
+        instance = self.get_instance(height)
+        if instance is None:
+            log.warning(f'Not starting height {height}, it is outside of the window or already decided')
+            return
+        if height in self.started:
+            log.warning(f'Height {height} was already started')
+            return
+        self.started.add(height)
+        if instance.store.get_state() == "DECIDED":
+            # Decided before this node restarted
+            log.info(f'Height {height} was already decided')
+            self.commit_quorums[height] = instance.store.get_decided_quorum()
+            instance.resolve_decided_value(lambda value: self.decide(height, value))
+            return
+        if instance.node_identity == instance.store.get_leader():
+            log.info(f'This node is leader of height {height}')
+        if start_time is None:
+            instance.start()
+        else:
+            self.timers.call_at(start_time.timestamp(), instance.start)
+
+    def process_message(self, message):
+        # Routes `message` to the instance of its height, returns the result of `Consensus.process_message`
+        if message.type == "ROUND_CHANGE" and message.height in self.commit_quorums:
+            self.send_commit_quorum(message)
+        instance = self.get_instance(message.height)
+        if instance is None:
+            log.debug('Dropping message for height %s, current height is %s', message.height, self.current_height)
+            MESSAGES.labels(message.type, "MESSAGE_REJECTED").inc()
+            return "MESSAGE_REJECTED"
+        started = time.perf_counter()
+        process_msg_result = instance.process_message(message)
+        PROCESS_SECONDS.labels(message.type).observe(time.perf_counter() - started)
+        MESSAGES.labels(message.type, process_msg_result).inc()
+        log.debug('process_message() of height %s returned %s', message.height, process_msg_result)
+        if process_msg_result == "STOP_TIMER":
+            log.info(f'Successfully DECIDED height {message.height}')
+            self.commit_quorums[message.height] = instance.store.get_decided_quorum()
+            instance.resolve_decided_value(lambda value: self.decide(message.height, value))
+        elif instance.store.get_state() == "COMMITTED":
+            self.start_pipelined_heights()
+        return process_msg_result
+
+    def send_commit_quorum(self, rc_message):
+        # The sender of `rc_message` did not see the decision of its height, which may already be garbage-collected here
+        key = (rc_message.height, rc_message.sender)
+        if self.send is None or rc_message.round <= self.answered_rounds.get(key, 0):
+            return
+        if not self.verifier.verify_batch([rc_message])[0]:
+            return
+        # Answered once per round, a node that still did not catch up asks again in its next round
+        self.answered_rounds[key] = rc_message.round
+        log.info(f'Sending the COMMIT quorum of height {rc_message.height} to node {rc_message.sender}')
+        self.send(self.commit_quorums[rc_message.height], rc_message.sender)
+
+    def process_messages(self, messages):
+        # Verifies the signatures of the messages of each height together (see `Consensus.process_messages`), then processes them in order
+        for height in sorted(set(message.height for message in messages)):
+            instance = self.get_instance(height)
+            if instance is not None:
+                instance.verifier.verify_batch([message for message in messages if message.height == height])
+        return [self.process_message(message) for message in messages]
+
+    def start_pipelined_heights(self):
+        # Starts the heights after the current height whose previous height is COMMITTED or decided,
+        # keeping at most `pipeline_depth` heights in flight
+        for height in range(self.current_height+1, self.current_height+self.pipeline_depth):
+            if self.is_done_at(height) or not self.is_committed(height-1):
+                return
+            if height not in self.started:
+                log.info(f'Height {height-1} is committed, starting height {height}')
+                self.start_height(height)
+
+    def decide(self, height, value):
+        # With pipelining, a height can be decided before the heights below it. `on_decided` is still called in height order.
+        self.decided_values[height] = value
+        previous_height = self.current_height
+        while self.current_height in self.decided_values:
+            if self.on_decided is not None:
+                self.on_decided(self.current_height, self.decided_values[self.current_height])
+            self.current_height += 1
+            DECIDED_HEIGHTS.inc()
+        HEIGHT.set(self.current_height)
+        expired = []
+        while len(self.decided_values) > self.retention:
+            expired.append(min(self.decided_values))
+            del self.decided_values[expired[-1]]
+        for height in [height for height in self.commit_quorums if height < min(self.decided_values)]:
+            del self.commit_quorums[height]
+        for key in [key for key in self.answered_rounds if key[0] not in self.commit_quorums]:
+            del self.answered_rounds[key]
+        self.collect_garbage()
+        if self.on_expired is not None:
+            for height in expired:
+                self.on_expired(height)
+        if self.current_height != previous_height and not self.is_done():
+            if self.current_height not in self.started:
+                self.start_height(self.current_height)
+            self.start_pipelined_heights()
+
+    def is_decided(self, height):
+        if height in self.instances:
+            return self.instances[height].store.get_state() == "DECIDED"
+        return height in self.decided_values
+
+    def is_committed(self, height):
+        # True once this node has seen a PREPARE quorum for `height`, i.e. the value of `height` can no longer change
+        if height in self.instances:
+            return self.instances[height].store.get_state() in ["COMMITTED", "DECIDED"]
+        return height in self.decided_values
+
+    def collect_garbage(self):
+        # Decided instances below the current height only reject messages, so they are dropped
+        for height in [height for height in self.instances if height < self.current_height]:
+            instance = self.instances.pop(height)
+            instance.stop_timer()
+            instance.store.close()
+        INSTANCES.set(len(self.instances))
+        self.started = set(height for height in self.started if height >= self.current_height)
+
+    def is_done(self):
+        return self.is_done_at(self.current_height)
+
+    def is_done_at(self, height):
+        # True if `height` is past the last height to decide
+        return self.num_heights is not None and height >= self.first_height + self.num_heights
@@ -0,0 +1,179 @@
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+
+# Process-wide metrics, exposed in the Prometheus text format at GET /metrics
+# Modules create their metrics once, at import, and update them on the hot path. A labelled metric is updated through
+# `metric.labels(...)`, whose result can be kept to skip the lookup.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# In seconds, from sub-millisecond message processing to backed-off rounds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            assert metric.name not in self.metrics, f"Metric {metric.name} is already registered"
+            self.metrics[metric.name] = metric
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(metric.expose() for metric in metrics)
+
+    def handle_get(self, path, headers, body):
+        # Route handler for `network.HTTPListener`
+        return 200, CONTENT_TYPE, self.expose().encode()
+
+REGISTRY = Registry()
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value)) if type(value) == float else str(value)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, names, values):
+        return [f'{name}{format_labels(names, values)} {format_value(self.value)}']
+
+class GaugeValue(CounterValue):
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        # The gauge is read from `function()` when it is exposed
+        self.function = function
+
+    def samples(self, name, names, values):
+        value = self.function() if self.function is not None else self.value
+        return [f'{name}{format_labels(names, values)} {format_value(value)}']
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # counts[i] is the number of observations in (buckets[i-1], buckets[i]], the last one is for observations above every bucket
+        self.counts = [0 for i in range(len(buckets) + 1)]
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, names, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [math.inf], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(list(names) + ["le"], list(values) + [format_value(bound)])} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(names, values)} {format_value(total)}')
+        lines.append(f'{name}_count{format_labels(names, values)} {cumulative}')
+        return lines
+
+class Metric(ABC):
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        # `labels` are the names of the labels of the metric. A metric without labels is updated directly, e.g. `counter.inc()`
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            # Exposed as 0 before the first update
+            self.labels()
+        registry.register(self)
+
+    @abstractmethod
+    def create_child(self):
+        # Returns the object that holds the value of the metric for one set of label values
+        pass
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            assert len(values) == len(self.label_names), f"Metric {self.name} has labels {self.label_names}"
+            with self.lock:
+                child = self.children.setdefault(values, self.create_child())
+        return child
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items(), key=lambda item: [str(value) for value in item[0]]):
+            lines.extend(child.samples(self.name, self.label_names, values))
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def create_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def create_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels=labels, registry=registry)
+
+    def create_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
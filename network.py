@@ -0,0 +1,245 @@
+import asyncio
+from http import HTTPStatus
+import threading
+import time
+import httpx
+from consensus import encode_batch
+from metrics import Counter, Gauge, Histogram
+from logs import SampledLog
+import logging
+
+log = logging.getLogger(__name__)
+# Logs of every broadcast message
+message_log = SampledLog(log)
+
+SEND_SECONDS = Histogram('broadcast_send_seconds', 'Time to POST a message to a peer, until its response', ['peer'])
+SEND_ERRORS = Counter('broadcast_send_errors_total', 'Failed POSTs of a message to a peer', ['peer'])
+IN_FLIGHT = Gauge('broadcast_in_flight', 'Messages being sent to a peer')
+BATCH_MESSAGES = Histogram('broadcast_batch_messages', 'Messages per request sent to a peer', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+class AsyncBroadcaster:
+    def __init__(self, peers, timeout=1, max_connections_per_peer=4, keepalive_expiry=30, wire_format="binary", coalesce_window=0, coalesce_max=64, urgent_types=()):
+        # `peers` is the list of `host:port` strings that messages are usually sent to
+        # Each peer gets its own keep-alive connection pool inside one shared `httpx.AsyncClient`
+        self.peers = list(peers)
+        # `wire_format` is "binary" or "json". A peer that answers 415 to binary messages is sent JSON from then on
+        self.wire_format = wire_format
+        self.peer_wire_formats = {}
+        self.timeout = timeout
+        self.max_connections_per_peer = max_connections_per_peer
+        self.keepalive_expiry = keepalive_expiry
+        # Messages to the same peer that are broadcast within `coalesce_window` seconds of the first one are sent in one batch request
+        # of at most `coalesce_max` messages (see `consensus.encode_batch`), which all peers must accept. Messages whose type is
+        # in `urgent_types` are sent right away. Every message is sent on its own if `coalesce_window` is 0.
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
+        self.urgent_types = set(urgent_types)
+        # `outbox` maps peer -> list of (message, asyncio.Future of the result) waiting to be sent, only used on the thread of `loop`
+        self.outbox = {}
+        self.flush_timers = {}
+        self.batch_sends = set()
+        # The broadcaster runs its own event loop in a background thread, so callers never block on the network
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='broadcaster', daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(self._create_client(), self.loop).result()
+
+    async def _create_client(self):
+        limits = httpx.Limits(max_connections=self.max_connections_per_peer, max_keepalive_connections=self.max_connections_per_peer, keepalive_expiry=self.keepalive_expiry)
+        mounts = {}
+        for peer in self.peers:
+            mounts['http://'+peer] = httpx.AsyncHTTPTransport(limits=limits)
+        return httpx.AsyncClient(timeout=self.timeout, limits=limits, mounts=mounts)
+
+    async def _post(self, peer, content_type, body):
+        url = 'http://'+peer+'/messages'
+        started = time.perf_counter()
+        IN_FLIGHT.inc()
+        try:
+            response = await self.client.post(url, content=body, headers={'Content-Type': content_type})
+            SEND_SECONDS.labels(peer).observe(time.perf_counter() - started)
+            if response.status_code == 415:
+                return response.status_code
+            if response.status_code != 200:
+                log.warning(f'Failed POST to {url}, response status code: {response.status_code}')
+                SEND_ERRORS.labels(peer).inc()
+            return response.status_code
+        except httpx.HTTPError as e:
+            log.error(f'Failed POST to {url}: {e!r}')
+            SEND_ERRORS.labels(peer).inc()
+            return e
+        finally:
+            IN_FLIGHT.dec()
+
+    async def _send(self, peer, msg, bodies):
+        # `bodies` caches the encoding of `msg` per wire format, so each format is encoded at most once per broadcast
+        wire_format = self.peer_wire_formats.get(peer, self.wire_format)
+        if wire_format not in bodies:
+            bodies[wire_format] = msg.encode(wire_format)
+        content_type, body = bodies[wire_format]
+        BATCH_MESSAGES.observe(1)
+        result = await self._post(peer, content_type, body)
+        if result == 415 and wire_format != "json":
+            log.info(f'{peer} does not accept {wire_format} messages, falling back to JSON')
+            self.peer_wire_formats[peer] = "json"
+            return await self._send(peer, msg, bodies)
+        return result
+
+    async def _send_batch(self, peer, messages):
+        wire_format = self.peer_wire_formats.get(peer, self.wire_format)
+        content_type, body = encode_batch(messages, wire_format)
+        BATCH_MESSAGES.observe(len(messages))
+        result = await self._post(peer, content_type, body)
+        if result == 415 and wire_format != "json":
+            log.info(f'{peer} does not accept {wire_format} messages, falling back to JSON')
+            self.peer_wire_formats[peer] = "json"
+            return await self._send_batch(peer, messages)
+        return result
+
+    def _enqueue(self, peer, msg):
+        # Adds `msg` to the outbox of `peer`, returns the future of the result of sending it
+        future = self.loop.create_future()
+        pending = self.outbox.setdefault(peer, [])
+        pending.append((msg, future))
+        if len(pending) >= self.coalesce_max:
+            self._flush(peer)
+        elif len(pending) == 1:
+            self.flush_timers[peer] = self.loop.call_later(self.coalesce_window, self._flush, peer)
+        return future
+
+    def _flush(self, peer):
+        timer = self.flush_timers.pop(peer, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self.outbox.pop(peer, [])
+        if pending:
+            task = self.loop.create_task(self._send_pending(peer, pending))
+            self.batch_sends.add(task)
+            task.add_done_callback(self.batch_sends.discard)
+
+    async def _send_pending(self, peer, pending):
+        if len(pending) == 1:
+            result = await self._send(peer, pending[0][0], {})
+        else:
+            result = await self._send_batch(peer, [msg for msg, future in pending])
+        for msg, future in pending:
+            if not future.done():
+                future.set_result(result)
+
+    async def _broadcast(self, msg, bodies, peers, urgent):
+        if urgent:
+            results = await asyncio.gather(*[self._send(peer, msg, bodies) for peer in peers])
+        else:
+            results = await asyncio.gather(*[self._enqueue(peer, msg) for peer in peers])
+        return dict(zip(peers, results))
+
+    def broadcast(self, msg, peers=None, urgent=None):
+        """
+        Sends `msg` to all `peers` in parallel without blocking the calling thread.
+        Unless `urgent` is True, or the type of `msg` is one of `urgent_types`, the message can wait
+        up to `coalesce_window` seconds to be sent along with the next messages to the same peer.
+
+        Returns a `concurrent.futures.Future` that resolves to a dict mapping each peer to
+        the HTTP status code of its response, or to the exception raised while sending to it.
+        """
+        if peers is None:
+            peers = self.peers
+        if urgent is None:
+            urgent = self.coalesce_window <= 0 or msg.type in self.urgent_types
+        message_log.debug('Broadcasting message to %s peers, message: %s', len(peers), msg)
+        bodies = {self.wire_format: msg.encode(self.wire_format)} if urgent else {}
+        return asyncio.run_coroutine_threadsafe(self._broadcast(msg, bodies, list(peers), urgent), self.loop)
+
+    async def _flush_all(self):
+        for peer in list(self.outbox):
+            self._flush(peer)
+        if self.batch_sends:
+            await asyncio.gather(*self.batch_sends)
+
+    def close(self):
+        # Messages that are still waiting to be coalesced are sent first
+        asyncio.run_coroutine_threadsafe(self._flush_all(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class HTTPListener:
+    def __init__(self, max_body_size=16*1024*1024):
+        # `routes` maps (method, path) -> handler
+        # A handler is called as handler(path, headers, body) and returns (status_code, content_type, response_body),
+        # or a coroutine that does, to wait without blocking other connections
+        # A path ending with '/' matches every path that starts with it
+        # Requests with a body of more than `max_body_size` bytes are answered with 413 without reading the body
+        self.routes = {}
+        self.max_body_size = max_body_size
+        self.server = None
+
+    def add_route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def find_handler(self, method, path):
+        if (method, path) in self.routes:
+            return self.routes[(method, path)]
+        prefixes = [route_path for (route_method, route_path) in self.routes if route_method == method and route_path.endswith('/') and path.startswith(route_path)]
+        if prefixes:
+            return self.routes[(method, max(prefixes, key=len))]
+        return None
+
+    async def dispatch(self, method, path, headers, body):
+        handler = self.find_handler(method, path)
+        if handler is None:
+            return 404, 'text/plain', b'Not found'
+        try:
+            result = handler(path, headers, body)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except Exception:
+            log.error(f'Handler for {method} {path} failed', exc_info=True)
+            return 500, 'text/plain', b'Internal error'
+
+    async def handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1 server with keep-alive, enough for the peer-to-peer `/messages` traffic
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if content_length < 0:
+                    raise ValueError(f'Invalid Content-Length {content_length}')
+                if content_length > self.max_body_size:
+                    # The body is left unread, so the connection cannot be reused
+                    log.warning(f'Rejecting {method} {target} with a body of {content_length} bytes, the maximum is {self.max_body_size}')
+                    status, content_type, response_body = 413, 'text/plain', b'Body too large'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(content_length) if content_length > 0 else b''
+                    status, content_type, response_body = await self.dispatch(method, target.split('?')[0], headers, body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                response_head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(response_body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+                writer.write(response_head.encode('latin-1') + response_body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            log.debug('Dropping malformed or closed connection', exc_info=True)
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        log.info(f'Listening on {host}:{port}')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
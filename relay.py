@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import logging
+
+log = logging.getLogger(__name__)
+
+# Tree-based dissemination: instead of sending every message to all N nodes itself, a node sends it to a few children,
+# which relay it down a tree rooted at the sender. The sender's uplink does O(fanout) work per message instead of O(N).
+# Relaying pays off for the large messages that one node sends to all: the PRE_PREPARE of the leader, which carries the value,
+# and ROUND_CHANGE messages, which carry a quorum of PREPARE messages. PREPARE and COMMIT messages are small and every node sends
+# one, so relaying them would only add hops and double the traffic of every node.
+
+class RelayTree:
+    def __init__(self, nodes, fanout=8, trees=2):
+        # `nodes` is a dict that maps node_index -> ConsensusNode
+        # Every message is relayed along `trees` trees rooted at its sender. In tree t, the other nodes are taken in ring order
+        # after the sender, rotated by t/trees of the ring, and the node at position p (the sender is at position 0) relays to
+        # the nodes at positions p*fanout+1 ... p*fanout+fanout. The relays near the root of one tree are leaves of the others,
+        # so a crashed relay does not cut off the nodes below it.
+        assert fanout >= 1 and trees >= 1, "fanout and trees must be at least 1"
+        self.node_indices = sorted(nodes)
+        self.fanout = fanout
+        self.trees = trees
+        # `children` caches (origin, node_index) -> children of node_index over all trees of messages from origin
+        self.children = {}
+
+    def get_order(self, origin, tree):
+        i = self.node_indices.index(origin)
+        others = self.node_indices[i+1:] + self.node_indices[:i]
+        shift = tree * len(others) // self.trees
+        return [origin] + others[shift:] + others[:shift]
+
+    def get_children(self, origin, node_index):
+        key = (origin, node_index)
+        if key not in self.children:
+            children = []
+            if origin in self.node_indices and node_index in self.node_indices:
+                for tree in range(self.trees):
+                    order = self.get_order(origin, tree)
+                    position = order.index(node_index)
+                    for child in order[position*self.fanout+1:(position+1)*self.fanout+1]:
+                        if child not in children:
+                            children.append(child)
+            self.children[key] = children
+        return self.children[key]
+
+class RelayBroadcaster:
+    def __init__(self, broadcaster, peers, node_identity, tree, verifier, relay_types=("PRE_PREPARE", "ROUND_CHANGE"), cache_size=65536):
+        # Sends the messages of this node down the trees of `tree` (a `RelayTree`) through `broadcaster`, e.g. `network.AsyncBroadcaster`,
+        # and relays the messages of other nodes that this node receives, see `relay`
+        # `peers` is the list of the peers of all nodes, by node index
+        # `verifier` is a `signing.SignatureVerifier`, only messages with valid signatures are relayed
+        # Only messages whose type is in `relay_types` are relayed, the others are sent directly to all nodes
+        # The digests of the last `cache_size` received messages are kept, to relay and process every message once
+        self.broadcaster = broadcaster
+        self.peers = list(peers)
+        self.node_identity = node_identity
+        self.tree = tree
+        self.verifier = verifier
+        self.relay_types = set(relay_types)
+        self.cache_size = cache_size
+        self.seen = OrderedDict()
+
+    def broadcast(self, msg, peers=None):
+        # Same interface as `network.AsyncBroadcaster.broadcast`. Messages to a subset of the peers, or that this node did not send, are sent directly.
+        if peers is None:
+            peers = self.peers
+        if self.node_identity is None or msg.sender != self.node_identity or msg.type not in self.relay_types or list(peers) != self.peers:
+            return self.broadcaster.broadcast(msg, peers)
+        # This node processes its own messages too
+        targets = [self.node_identity] + self.tree.get_children(msg.sender, self.node_identity)
+        return self.broadcaster.broadcast(msg, [self.peers[node_index] for node_index in targets])
+
+    def relay(self, msg):
+        # Called with every received message before it is processed. Sends `msg` on to the children of this node in the trees of its sender.
+        # Returns False if `msg` was already received, through another tree, in which case it does not need to be processed again,
+        # or if its signature is not valid, so that forged messages are neither relayed nor take the place of real ones in `seen`.
+        digest = msg.digest()
+        if digest in self.seen:
+            self.seen.move_to_end(digest)
+            return False
+        if not self.verifier.verify_batch([msg])[0]:
+            log.warning('Not relaying %s message with an invalid signature from node %s', msg.type, msg.sender)
+            return False
+        self.seen[digest] = True
+        while len(self.seen) > self.cache_size:
+            self.seen.popitem(last=False)
+        if self.node_identity is not None and msg.sender != self.node_identity and msg.type in self.relay_types:
+            children = self.tree.get_children(msg.sender, self.node_identity)
+            if children:
+                self.broadcaster.broadcast(msg, [self.peers[node_index] for node_index in children])
+        return True
+
+    def close(self):
+        self.broadcaster.close()
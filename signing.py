@@ -0,0 +1,104 @@
+import sys
+from collections import OrderedDict
+from nacl.signing import SigningKey, VerifyKey
+from nacl.exceptions import BadSignatureError
+
+# Ed25519 signatures over `ConsensusMessage.signing_digest()`. Keys and signatures are hex strings.
+
+def generate_keypair():
+    # Returns (private_key, public_key)
+    signing_key = SigningKey.generate()
+    return signing_key.encode().hex(), signing_key.verify_key.encode().hex()
+
+class MessageSigner:
+    def __init__(self, private_key: str):
+        self.signing_key = SigningKey(bytes.fromhex(private_key))
+        self.public_key = self.signing_key.verify_key.encode().hex()
+
+    def sign(self, message):
+        # Messages are immutable, so this returns a signed copy of `message`
+        signature = self.signing_key.sign(message.signing_digest()).signature.hex()
+        return message.with_signature(signature)
+
+def verify_message_signature(message, public_key: str):
+    # Verifies only `message` itself, not the messages in its justification
+    try:
+        VerifyKey(bytes.fromhex(public_key)).verify(message.signing_digest(), bytes.fromhex(message.siganture))
+        return True
+    except (BadSignatureError, ValueError):
+        return False
+
+class SignatureVerifier:
+    def __init__(self, nodes, cache_size=65536):
+        # `nodes` is a dict that maps node_index -> ConsensusNode
+        # Signatures are only checked for senders that have a public key
+        self.nodes = nodes
+        self.verify_keys = {}
+        for node_index, node in nodes.items():
+            if node.public_key:
+                self.verify_keys[node_index] = VerifyKey(bytes.fromhex(node.public_key))
+        # `verified` maps the key of a message -> result, so a message is verified once no matter how many justifications it shows up in
+        self.cache_size = cache_size
+        self.verified = OrderedDict()
+
+    def key(self, message):
+        # The signed part of a message and its signature. Unlike `message.digest()`, it leaves out the certificate, which is not signed,
+        # so a ROUND_CHANGE message that shows up without its certificate in a justification is not verified again
+        return message.signing_digest(), message.siganture
+
+    def collect(self, message, pending):
+        # Adds `message` and every message nested in its justification to `pending` (key -> message),
+        # nested messages first, skipping messages that are already verified
+        key = self.key(message)
+        if key in pending or key in self.verified:
+            return
+        for nested_message in message.data.get('justification', ()):
+            self.collect(nested_message, pending)
+        pending[key] = message
+
+    def verify_one(self, message):
+        if message.sender not in self.verify_keys:
+            return message.sender in self.nodes
+        try:
+            self.verify_keys[message.sender].verify(message.signing_digest(), bytes.fromhex(message.siganture))
+            return True
+        except (BadSignatureError, ValueError):
+            return False
+
+    def remember(self, key, result):
+        self.verified[key] = result
+        self.verified.move_to_end(key)
+        while len(self.verified) > self.cache_size:
+            self.verified.popitem(last=False)
+
+    def verify_batch(self, messages):
+        """
+        Verifies the signatures of `messages` and of all messages nested in their justifications.
+        Every distinct message is verified at most once, also across calls.
+
+        Returns a list with one bool per message in `messages`, which is True if the message and all of
+        its nested messages have valid signatures.
+        """
+        pending = OrderedDict()
+        for message in messages:
+            self.collect(message, pending)
+        # libsodium has no batch verification API, so the batch is verified one signature at a time.
+        # The batch still saves the work of messages that repeat within it or were verified before.
+        for key, message in pending.items():
+            # The result of a message covers its nested messages, which come before it in `pending`
+            result = self.verify_one(message) and all(self.is_verified(nested_message) for nested_message in message.data.get('justification', ()))
+            self.remember(key, result)
+        return [self.is_verified(message) for message in messages]
+
+    def is_verified(self, message):
+        key = self.key(message)
+        if key not in self.verified:
+            # Evicted from the cache, or never seen
+            return self.verify_batch([message])[0]
+        return self.verified[key]
+
+if __name__ == '__main__':
+    # python3 signing.py 4
+    # Prints one `private_key public_key` pair per line
+    for i in range(int(sys.argv[1]) if len(sys.argv) > 1 else 1):
+        print(*generate_keypair())
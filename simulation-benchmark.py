@@ -0,0 +1,137 @@
+import argparse
+import logging
+from consensus import Consensus
+from simulator import Simulation, silent, equivocate
+
+# python3 simulation-benchmark.py --nodes 4,16,64,256
+# Runs consecutive heights of `Consensus` on the in-process simulated network for each network size, and reports
+# decisions per second (of wall-clock and of virtual time), messages and bytes per decision, CPU time per delivered message
+# and round changes per decision. Results only depend on the code and the arguments, so they can be compared across commits.
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--nodes",
+    type = str,
+    default = "4,16,64,128,256",
+    help = "Comma-separated list of network sizes to benchmark"
+)
+parser.add_argument(
+    "--heights",
+    type = int,
+    default = 0,
+    help = "Number of heights to decide. Picked per network size if 0"
+)
+parser.add_argument(
+    "--pipeline_depth",
+    type = int,
+    default = 1,
+    help = "Number of heights that run at the same time"
+)
+parser.add_argument(
+    "--round_duration",
+    type = float,
+    default = 1,
+    help = "Timeout (in seconds of virtual time) of round 1"
+)
+parser.add_argument(
+    "--latency",
+    type = float,
+    default = 0.01,
+    help = "Delay (in seconds of virtual time) of every message"
+)
+parser.add_argument(
+    "--jitter",
+    type = float,
+    default = 0.0,
+    help = "Maximum random delay (in seconds of virtual time) added to every message"
+)
+parser.add_argument(
+    "--drop_rate",
+    type = float,
+    default = 0.0,
+    help = "Probability that a message is lost"
+)
+parser.add_argument(
+    "--reorder_rate",
+    type = float,
+    default = 0.0,
+    help = "Probability that a message is delayed past messages sent after it"
+)
+parser.add_argument(
+    "--coalesce_window",
+    type = float,
+    default = 0.0,
+    help = "Window (in seconds of virtual time) in which messages from one node to the same peer are sent in one request, see network.AsyncBroadcaster"
+)
+parser.add_argument(
+    "--dissemination",
+    type = str,
+    default = "direct",
+    choices = ["direct", "tree"],
+    help = "How messages reach all nodes, see relay.py"
+)
+parser.add_argument(
+    "--fanout",
+    type = int,
+    default = 8,
+    help = "Fanout of the relay trees (--dissemination tree)"
+)
+parser.add_argument(
+    "--relay_trees",
+    type = int,
+    default = 2,
+    help = "Number of relay trees (--dissemination tree)"
+)
+parser.add_argument(
+    "--crashed",
+    type = str,
+    default = "",
+    help = "Comma-separated list of node indices that are down"
+)
+parser.add_argument(
+    "--byzantine",
+    type = str,
+    default = "",
+    help = "Comma-separated list of node indices that follow --behavior"
+)
+parser.add_argument(
+    "--behavior",
+    type = str,
+    default = "equivocate",
+    choices = ["equivocate", "silent"],
+    help = "Behavior of the --byzantine nodes"
+)
+parser.add_argument(
+    "--duration",
+    type = float,
+    default = 600,
+    help = "Maximum duration (in seconds of virtual time) of each simulation"
+)
+parser.add_argument(
+    "--seed",
+    type = int,
+    default = 0,
+    help = "Seed of the simulated network"
+)
+args = parser.parse_args()
+
+def parse_indices(s, num_nodes):
+    return [int(i) for i in s.split(',') if i and int(i) < num_nodes]
+
+if __name__ == '__main__':
+    # The simulation logs every message otherwise
+    logging.disable(logging.CRITICAL)
+    behavior = {"equivocate": equivocate, "silent": silent}[args.behavior]
+    print(f'{"N":>5} {"heights":>8} {"decided":>8} {"agree":>6} {"dec/s":>9} {"dec/virt s":>11} {"msgs/dec":>10} {"reqs/dec":>10} {"max node KB/dec":>16} {"KB/dec":>9} {"us/msg":>8} {"rc/dec":>7} {"wall s":>8}')
+    for num_nodes in [int(n) for n in args.nodes.split(',')]:
+        heights = args.heights or max(2, 320 // num_nodes)
+        byzantine = {node_index: behavior for node_index in parse_indices(args.byzantine, num_nodes)}
+        simulation = Simulation(num_nodes, consensus_class=Consensus, round_duration=args.round_duration, heights=heights, pipeline_depth=args.pipeline_depth,
+                                crashed=parse_indices(args.crashed, num_nodes), byzantine=byzantine, seed=args.seed, latency=args.latency, jitter=args.jitter,
+                                drop_rate=args.drop_rate, reorder_rate=args.reorder_rate, coalesce_window=args.coalesce_window, urgent_types=["PRE_PREPARE"],
+                                dissemination=args.dissemination, fanout=args.fanout, relay_trees=args.relay_trees)
+        stats = simulation.run(args.duration)
+        format_optional = lambda value, scale, spec: format(value*scale, spec) if value is not None else '-'
+        print(f'{num_nodes:>5} {heights:>8} {stats["decided_heights"]:>8} {str(stats["agreement"]):>6} {stats["decisions_per_second"]:>9.2f} {stats["decisions_per_virtual_second"]:>11.2f} '
+              f'{format_optional(stats["messages_per_decision"], 1, ".0f"):>10} {format_optional(stats["requests_per_decision"], 1, ".0f"):>10} {format_optional(stats["max_node_bytes_per_decision"], 1/1024, ".1f"):>16} {format_optional(stats["bytes_per_decision"], 1/1024, ".1f"):>9} '
+              f'{format_optional(stats["cpu_per_message"], 1e6, ".1f"):>8} {format_optional(stats["round_changes_per_decision"], 1, ".2f"):>7} {stats["wall_time"]:>8.2f}')
@@ -0,0 +1,276 @@
+import datetime
+import random
+import time
+from collections import defaultdict
+from consensus import Consensus, ConsensusMessage, ConsensusNode, ConsensusStore
+from manager import ConsensusManager
+from relay import RelayTree, RelayBroadcaster
+from signing import SignatureVerifier
+from timers import VirtualTimers
+import logging
+
+log = logging.getLogger(__name__)
+
+# In-process simulation of a network of nodes, without a broker or sockets
+# Every node runs a `ConsensusManager` over one shared `VirtualTimers` clock, so a simulation only takes the CPU time of processing
+# its messages, and the same seed always gives the same run.
+
+def silent(message, peer):
+    # Byzantine behavior: sends nothing, but keeps receiving
+    return None
+
+def equivocate(message, peer):
+    # Byzantine behavior: sends a different value to every odd-numbered peer
+    if peer % 2 == 0 or 'value' not in message.data:
+        return message
+    data = dict(message.data)
+    value = data['value']
+    if type(value) == int:
+        data['value'] = value + 2
+    elif type(value) == str:
+        data['value'] = value[::-1]
+    return ConsensusMessage(message.type, message.round, data, message.sender, height=message.height)
+
+class SimulatedNetwork:
+    def __init__(self, timers, latency=0.01, jitter=0.0, drop_rate=0.0, reorder_rate=0.0, reorder_delay=0.05, seed=0, wire=True, coalesce_window=0, coalesce_max=64, urgent_types=()):
+        # Delivers messages on `timers` (a `timers.VirtualTimers`) after `latency` seconds, plus a uniform random delay of up to `jitter` seconds
+        # A message is lost with probability `drop_rate`, and delayed by another `reorder_delay` seconds with probability `reorder_rate`,
+        # so that it arrives after messages that were sent later
+        # With `wire`, every delivered message is encoded and decoded, as it would be on a real network
+        # `coalesce_window`, `coalesce_max` and `urgent_types` group messages into requests like `network.AsyncBroadcaster` does.
+        # Delays and drops apply to whole requests.
+        self.timers = timers
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.reorder_rate = reorder_rate
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.wire = wire
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
+        self.urgent_types = set(urgent_types)
+        # `outbox` maps (sender, peer) -> messages waiting to be sent in one request
+        self.outbox = {}
+        self.flush_timers = {}
+        # `receivers` maps node_index -> function called with every message delivered to that node
+        self.receivers = {}
+        self.crashed = set()
+        # `byzantine` maps node_index -> behavior, a function called as behavior(message, peer) for every message sent by that node,
+        # which returns the message that `peer` receives instead, or None to send nothing. Messages of other nodes that it relays are
+        # signed by their sender, so they are relayed unchanged.
+        self.byzantine = {}
+        self.sent = 0
+        # Messages sent by each node, including the messages that it relays
+        self.sent_by_node = defaultdict(int)
+        self.bytes_by_node = defaultdict(int)
+        self.requests = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        # CPU time (in seconds) spent by the receivers on delivered messages
+        self.cpu_time = 0.0
+        self.messages_by_type = defaultdict(int)
+
+    def add_node(self, node_index, receiver):
+        self.receivers[node_index] = receiver
+
+    def crash(self, node_index):
+        # A crashed node neither sends nor receives messages, including the ones already in flight to it
+        self.crashed.add(node_index)
+
+    def recover(self, node_index):
+        self.crashed.discard(node_index)
+
+    def broadcast(self, message, peers, node_index=None):
+        # Same interface as `network.AsyncBroadcaster.broadcast`, where `peers` are node indices
+        # `node_index` is the node that sends `message`, its sender if it is None, see `SimulatedEndpoint`
+        if node_index is None:
+            node_index = message.sender
+        if node_index in self.crashed:
+            return None
+        behavior = self.byzantine.get(node_index) if node_index == message.sender else None
+        body = message.to_bytes() if self.wire else None
+        for peer in peers:
+            sent_message = message
+            if behavior is not None:
+                sent_message = behavior(message, peer)
+                if sent_message is None:
+                    continue
+            self.send(sent_message, peer, body if sent_message is message else None, node_index)
+        return None
+
+    def send(self, message, peer, body=None, node_index=None):
+        if node_index is None:
+            node_index = message.sender
+        self.sent += 1
+        self.sent_by_node[node_index] += 1
+        self.messages_by_type[message.type] += 1
+        if self.wire:
+            body = body if body is not None else message.to_bytes()
+            self.bytes_sent += len(body)
+            self.bytes_by_node[node_index] += len(body)
+        item = message if body is None else body
+        if self.coalesce_window <= 0 or message.type in self.urgent_types:
+            self.transmit(peer, [item])
+            return
+        key = (node_index, peer)
+        pending = self.outbox.setdefault(key, [])
+        pending.append(item)
+        if len(pending) >= self.coalesce_max:
+            self.flush(key)
+        elif len(pending) == 1:
+            self.flush_timers[key] = self.timers.call_later(self.coalesce_window, lambda: self.flush(key))
+
+    def flush(self, key):
+        timer = self.flush_timers.pop(key, None)
+        if timer is not None:
+            self.timers.cancel(timer)
+        pending = self.outbox.pop(key, [])
+        if pending:
+            self.transmit(key[1], pending)
+
+    def transmit(self, peer, items):
+        # Sends one request with `items` to `peer`
+        self.requests += 1
+        if peer in self.crashed or self.random.random() < self.drop_rate:
+            self.dropped += len(items)
+            return
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.random.random() < self.reorder_rate:
+            delay += self.reorder_delay
+        self.timers.call_later(delay, lambda: self.deliver(items, peer))
+
+    def deliver(self, items, peer):
+        if peer in self.crashed:
+            self.dropped += len(items)
+            return
+        for message in items:
+            started = time.process_time()
+            if type(message) == bytes:
+                message = ConsensusMessage.decode(message)
+            self.receivers[peer](message)
+            self.cpu_time += time.process_time() - started
+            self.delivered += 1
+
+class SimulatedEndpoint:
+    # The broadcaster of one node on a `SimulatedNetwork`
+    def __init__(self, network, node_index):
+        self.network = network
+        self.node_index = node_index
+
+    def broadcast(self, message, peers):
+        return self.network.broadcast(message, peers, self.node_index)
+
+class Simulation:
+    def __init__(self, num_nodes, consensus_class=Consensus, byz_quorum=None, rc_threshold=None, round_duration=1, heights=10, pipeline_depth=1,
+                 weights=None, crashed=(), byzantine=None, instance_kwargs=None, start_time=1000.0, seed=0, dissemination="direct", fanout=8, relay_trees=2, **network_kwargs):
+        # Simulates `num_nodes` nodes that run `consensus_class` for `heights` heights
+        # `byz_quorum` and `rc_threshold` default to N-f and f+1 for f = (N-1)//3 faulty nodes of weight 1
+        # `crashed` are the nodes that are down from the start, `byzantine` maps node_index -> behavior, see `SimulatedNetwork`
+        # `instance_kwargs`, if given, is called as instance_kwargs(node_index, height) and returns extra arguments for that instance
+        # With `dissemination` "tree", messages are relayed along `relay_trees` trees of `fanout`, see `relay.RelayTree`
+        # The other arguments are passed to `SimulatedNetwork`
+        faulty = (num_nodes - 1) // 3
+        self.num_nodes = num_nodes
+        self.byz_quorum = byz_quorum if byz_quorum is not None else num_nodes - faulty
+        self.rc_threshold = rc_threshold if rc_threshold is not None else faulty + 1
+        self.heights = heights
+        self.start_time = start_time
+        self.timers = VirtualTimers(start_time)
+        self.network = SimulatedNetwork(self.timers, seed=seed, **network_kwargs)
+        self.network.byzantine = dict(byzantine or {})
+        weights = weights if weights is not None else [1 for i in range(num_nodes)]
+        self.nodes = {i: ConsensusNode(i, weight=weights[i]) for i in range(num_nodes)}
+        # `decisions` maps node_index -> {height: (value, virtual time of the decision, round of the decision)}
+        self.decisions = defaultdict(dict)
+        self.managers = {}
+        tree = RelayTree(self.nodes, fanout=fanout, trees=relay_trees) if dissemination == "tree" else None
+        for node_index in range(num_nodes):
+            broadcaster = SimulatedEndpoint(self.network, node_index)
+            # Shared by the relay and the instances of all heights of the node, as in `worker.run`
+            verifier = SignatureVerifier(self.nodes)
+            if tree is not None:
+                broadcaster = RelayBroadcaster(broadcaster, list(range(num_nodes)), node_index, tree, verifier)
+            self.managers[node_index] = self.create_manager(node_index, consensus_class, round_duration, pipeline_depth, instance_kwargs, broadcaster, verifier)
+            self.network.add_node(node_index, self.create_receiver(self.managers[node_index], broadcaster))
+        for node_index in crashed:
+            self.network.crash(node_index)
+
+    def create_receiver(self, manager, broadcaster):
+        if not isinstance(broadcaster, RelayBroadcaster):
+            return manager.process_message
+        def receive(message):
+            if broadcaster.relay(message):
+                manager.process_message(message)
+        return receive
+
+    def create_manager(self, node_index, consensus_class, round_duration, pipeline_depth, instance_kwargs, broadcaster, verifier):
+        peers = list(range(self.num_nodes))
+        def create_instance(height):
+            kwargs = instance_kwargs(node_index, height) if instance_kwargs is not None else {}
+            store = ConsensusStore(node_index, peers)
+            return consensus_class(self.nodes, self.byz_quorum, self.rc_threshold, datetime.timedelta(seconds=round_duration), None, store, node_identity=node_index, broadcaster=broadcaster, height=height, timers=self.timers, verifier=verifier, **kwargs)
+        def on_decided(height, value):
+            instance = manager.instances.get(height)
+            round = instance.store.get_round() if instance is not None else None
+            self.decisions[node_index][height] = (value, self.timers.now(), round)
+        def send(messages, peer):
+            for message in messages:
+                broadcaster.broadcast(message, [peer])
+        manager = ConsensusManager(create_instance, self.timers, num_heights=self.heights, on_decided=on_decided, window=max(4, pipeline_depth), retention=max(16, pipeline_depth), pipeline_depth=pipeline_depth, send=send, verifier=verifier)
+        return manager
+
+    def correct_nodes(self):
+        return [node_index for node_index in range(self.num_nodes) if node_index not in self.network.crashed and node_index not in self.network.byzantine]
+
+    def is_done(self):
+        return all(len(self.decisions[node_index]) == self.heights for node_index in self.correct_nodes())
+
+    def run(self, duration=60):
+        # Runs the simulation until every correct node decided every height, or for `duration` virtual seconds
+        # Returns the statistics of the run, see `get_stats`
+        start = datetime.datetime.fromtimestamp(self.start_time)
+        for node_index, manager in self.managers.items():
+            if node_index not in self.network.crashed:
+                manager.start_height(0, start)
+        deadline = self.start_time + duration
+        started = time.perf_counter()
+        while not self.is_done():
+            next_time = self.timers.next_time()
+            if next_time is None or next_time > deadline:
+                break
+            self.timers.run_until(next_time)
+        return self.get_stats(time.perf_counter() - started)
+
+    def get_stats(self, wall_time):
+        correct_nodes = self.correct_nodes()
+        decided_heights = min(len(self.decisions[node_index]) for node_index in correct_nodes) if correct_nodes else 0
+        values = [set(self.decisions[node_index][height][0] for node_index in correct_nodes) for height in range(decided_heights)]
+        decision_times = [max(self.decisions[node_index][height][1] for node_index in correct_nodes) for height in range(decided_heights)]
+        round_changes = sum(self.decisions[node_index][height][2] - 1 for node_index in correct_nodes for height in range(decided_heights) if self.decisions[node_index][height][2] is not None)
+        virtual_time = (decision_times[-1] if decision_times else self.timers.now()) - self.start_time
+        network = self.network
+        return {
+            'nodes': self.num_nodes,
+            'decided_heights': decided_heights,
+            # True if all correct nodes decided the same value at every height
+            'agreement': all(len(height_values) == 1 for height_values in values),
+            'virtual_time': virtual_time,
+            'wall_time': wall_time,
+            'decisions_per_virtual_second': decided_heights / virtual_time if virtual_time > 0 else 0.0,
+            'decisions_per_second': decided_heights / wall_time if wall_time > 0 else 0.0,
+            'messages_sent': network.sent,
+            'messages_delivered': network.delivered,
+            'messages_dropped': network.dropped,
+            'messages_per_decision': network.sent / decided_heights if decided_heights else None,
+            'requests_per_decision': network.requests / decided_heights if decided_heights else None,
+            # Messages sent by the busiest node (usually a leader), per decided height
+            'max_node_messages_per_decision': max(network.sent_by_node.values()) / decided_heights if decided_heights and network.sent_by_node else None,
+            'max_node_bytes_per_decision': max(network.bytes_by_node.values()) / decided_heights if decided_heights and network.bytes_by_node else None,
+            'bytes_per_decision': network.bytes_sent / decided_heights if decided_heights else None,
+            'cpu_per_message': network.cpu_time / network.delivered if network.delivered else None,
+            # Round changes of the correct nodes, per decided height
+            'round_changes_per_decision': round_changes / (decided_heights * len(correct_nodes)) if decided_heights else None,
+            'messages_by_type': dict(network.messages_by_type),
+        }
@@ -19,13 +19,13 @@ do
   NODES="$NODES,localhost:$(( $PORT_START_ADDR + $i ))"
 done
 
-trap "echo 'Interrupted. Killing all IBFT processes.'; pkill -f 'python3 drand-consensus-worker.py|python3 flask-server.py'" INT
+trap "echo 'Interrupted. Killing all IBFT processes.'; pkill -f 'python3 drand-consensus-worker.py|python3 ingress-server.py'" INT
 
 NODE_ID=1
-echo python3 flask-server.py \
+echo python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID ))
-python3 flask-server.py \
+python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID )) &
 echo python3 drand-consensus-worker.py \
@@ -48,10 +48,10 @@ python3 drand-consensus-worker.py \
   --drand_round $DRAND_ROUND &
 #---------------------------------------------
 NODE_ID=2
-echo python3 flask-server.py \
+echo python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID ))
-python3 flask-server.py \
+python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID )) &
 echo python3 drand-consensus-worker.py \
@@ -74,10 +74,10 @@ python3 drand-consensus-worker.py \
   --drand_round $DRAND_ROUND &
 #---------------------------------------------
 NODE_ID=3
-echo python3 flask-server.py \
+echo python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID ))
-python3 flask-server.py \
+python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID )) &
 echo python3 drand-consensus-worker.py \
@@ -100,10 +100,10 @@ python3 drand-consensus-worker.py \
   --drand_round $DRAND_ROUND &
 #---------------------------------------------
 NODE_ID=0
-echo python3 flask-server.py \
+echo python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID ))
-python3 flask-server.py \
+python3 ingress-server.py \
 --node_identity $NODE_ID \
 --port $(( $PORT_START_ADDR + $NODE_ID )) &
 echo python3 drand-consensus-worker.py \
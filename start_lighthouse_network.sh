@@ -20,14 +20,14 @@ do
   NODES="$NODES,localhost:$(( $PORT_START_ADDR + $i ))"
 done
 
-trap "echo 'Interrupted. Killing all IBFT processes.'; pkill -f 'python3 lighthouse-consensus-worker.py|python3 flask-server.py'" INT
+trap "echo 'Interrupted. Killing all IBFT processes.'; pkill -f 'python3 lighthouse-consensus-worker.py|python3 ingress-server.py'" INT
 
 for NODE_ID in $(seq 1 $(( $NUM_NODES - 1 )))
 do
-  echo python3 flask-server.py \
+  echo python3 ingress-server.py \
   --node_identity $NODE_ID \
   --port $(( $PORT_START_ADDR + $NODE_ID ))
-  python3 flask-server.py \
+  python3 ingress-server.py \
   --node_identity $NODE_ID \
   --port $(( $PORT_START_ADDR + $NODE_ID )) &
   echo python3 lighthouse-consensus-worker.py \
@@ -50,10 +50,10 @@ do
     --eth2_slot $ETH2_SLOT &
 done
 
-echo python3 flask-server.py \
+echo python3 ingress-server.py \
 --node_identity 0 \
 --port $(( $PORT_START_ADDR + 0 ))
-python3 flask-server.py \
+python3 ingress-server.py \
 --node_identity 0 \
 --port $(( $PORT_START_ADDR + 0 )) &
 echo python3 lighthouse-consensus-worker.py \
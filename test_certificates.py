@@ -0,0 +1,55 @@
+import datetime
+from consensus import Consensus, ConsensusMessage, ConsensusNode, ConsensusStore, create_certificate, certificate_signers
+from signing import MessageSigner, generate_keypair
+
+# python3 -m pytest test_certificates.py
+
+def create_network(num_nodes):
+    keys = [generate_keypair() for i in range(num_nodes)]
+    nodes = {i: ConsensusNode(i, public_key=keys[i][1]) for i in range(num_nodes)}
+    signers = [MessageSigner(private_key) for private_key, public_key in keys]
+    byz_quorum = num_nodes - (num_nodes-1)//3
+    consensus = Consensus(nodes, byz_quorum, (num_nodes-1)//3 + 1, datetime.timedelta(seconds=1), None, ConsensusStore(0, list(range(num_nodes))), node_identity=0, height=1)
+    return consensus, signers
+
+def create_round_change(signers, senders, prepared_round=1, value=2, round=2):
+    prepares = [signers[sender].sign(ConsensusMessage("PREPARE", prepared_round, {'value': value}, sender, height=1)) for sender in senders]
+    data = {'prepared_round': prepared_round, 'prepared_value': value, 'certificate': create_certificate(prepares)}
+    return signers[0].sign(ConsensusMessage("ROUND_CHANGE", round, data, 0, height=1))
+
+def test_certificate_round_trip_with_highest_sender():
+    # 16 nodes fill the signer bitmap, the quorum of senders 5..15 includes the highest node index
+    consensus, signers = create_network(16)
+    for senders in [range(0, 11), range(5, 16)]:
+        rc_message = create_round_change(signers, senders)
+        for decoded in [ConsensusMessage.decode(rc_message.to_bytes()), ConsensusMessage.decode(rc_message.to_string())]:
+            assert certificate_signers(decoded.data['certificate']) == list(senders)
+            assert consensus.validate_round_change_message(decoded, 2)
+
+def test_certificate_below_quorum_is_rejected():
+    consensus, signers = create_network(16)
+    rc_message = create_round_change(signers, range(6, 16))
+    try:
+        consensus.validate_round_change_message(rc_message, 2)
+    except AssertionError:
+        return
+    assert False, "Certificate below quorum was accepted"
+
+def test_unprepared_round_change_with_certificate_is_rejected():
+    consensus, signers = create_network(4)
+    certificate = {'signers': 'ff', 'signatures': []}
+    rc_message = signers[1].sign(ConsensusMessage("ROUND_CHANGE", 2, {'prepared_round': 0, 'prepared_value': None, 'certificate': certificate}, 1, height=1))
+    try:
+        consensus.validate_round_change_message(rc_message, 2)
+    except AssertionError:
+        return
+    assert False, "Unprepared ROUND_CHANGE message with a certificate was accepted"
+
+def test_signed_pre_prepare_with_justification_survives_json():
+    # The JSON encoding lists the justification first, the signature must not depend on the order of the keys of `data`
+    consensus, signers = create_network(4)
+    rc_messages = [signers[sender].sign(ConsensusMessage("ROUND_CHANGE", 2, {'prepared_round': 0, 'prepared_value': None, 'certificate': None}, sender, height=1)) for sender in range(3)]
+    pre_prepare = signers[1].sign(ConsensusMessage("PRE_PREPARE", 2, {'value': 4, 'justification': rc_messages}, 1, height=1))
+    for decoded in [ConsensusMessage.decode(pre_prepare.to_bytes()), ConsensusMessage.decode(pre_prepare.to_string())]:
+        assert decoded.signing_digest() == pre_prepare.signing_digest()
+        assert consensus.verifier.verify_batch([decoded]) == [True]
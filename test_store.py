@@ -0,0 +1,52 @@
+import os
+from consensus import ConsensusMessage, ConsensusStore
+from wal import PersistentConsensusStore, delete_store, write_expired_height, read_expired_height
+
+# python3 -m pytest test_store.py
+
+def vote(type, round, sender, value=2):
+    return ConsensusMessage(type, round, {'value': value}, sender, height=1)
+
+def test_rounds_since_prepared_round_are_retained():
+    store = ConsensusStore(0, list(range(4)))
+    store.set_prepared_round(2)
+    store.add_message(vote("PREPARE", 3, 1))
+    store.set_round(6)
+    store.prune()
+    # Round 3 is before `round - history_rounds`, but after the prepared round
+    assert store.add_message(vote("PREPARE", 3, 2))
+    assert store.get_tally(3, "PREPARE").total_weight == 2
+    assert not store.add_message(vote("PREPARE", 1, 1))
+
+def test_rounds_before_history_are_pruned_without_prepared_round():
+    store = ConsensusStore(0, list(range(4)))
+    store.add_message(vote("PREPARE", 3, 1))
+    store.set_round(6)
+    store.prune()
+    assert 3 not in store.tallies
+    assert not store.add_message(vote("PREPARE", 4, 1))
+    assert store.add_message(vote("PREPARE", 5, 1))
+
+def test_commits_of_past_rounds_are_retained():
+    # A node that fell behind decides from the COMMIT quorum of any past round
+    store = ConsensusStore(0, list(range(4)))
+    store.add_message(vote("COMMIT", 1, 1))
+    store.add_message(vote("PREPARE", 1, 1))
+    store.set_round(6)
+    store.prune()
+    assert store.get_tally(1, "COMMIT").total_weight == 1
+    assert store.get_tally(1, "PREPARE").total_weight == 0
+    assert store.add_message(vote("COMMIT", 1, 2))
+    assert store.get_tally(1, "COMMIT").total_weight == 2
+
+def test_expired_store_is_deleted(tmp_path):
+    path = os.path.join(tmp_path, 'height_1')
+    store = PersistentConsensusStore(0, list(range(4)), path)
+    store.add_message(vote("PREPARE", 1, 1))
+    store.snapshot()
+    store.close()
+    assert read_expired_height(tmp_path) is None
+    write_expired_height(tmp_path, 1)
+    delete_store(path)
+    assert read_expired_height(tmp_path) == 1
+    assert os.listdir(tmp_path) == ['expired_height']
@@ -0,0 +1,52 @@
+from collections import deque
+import logging
+
+log = logging.getLogger(__name__)
+
+# Round timeout policies of `Consensus`. One policy can be shared by the instances of all heights.
+
+class ExponentialTimeout:
+    def __init__(self, base, max_exponent=10):
+        # The timeout of round r is `base * 2^(r-1)` seconds, as in the IBFT paper, so that rounds eventually last long enough to decide
+        # The exponent is capped at `max_exponent` so that the timeout stays finite
+        self.base = base
+        self.max_exponent = max_exponent
+
+    def get_base(self):
+        return self.base
+
+    def get_timeout(self, round):
+        return self.get_base() * 2**min(round-1, self.max_exponent)
+
+    def observe(self, latency):
+        # Called with the PRE_PREPARE -> DECIDED latency (in seconds) of every decision
+        pass
+
+class AdaptiveTimeout(ExponentialTimeout):
+    def __init__(self, base, max_exponent=10, min_base=0.05, multiplier=3, alpha=0.2, percentile=None, window=100):
+        # Tunes the timeout of round 1 to `multiplier` times the observed PRE_PREPARE -> DECIDED latency, within [min_base, base]
+        # Later rounds back off exponentially from there
+        # The latency is an EWMA with weight `alpha` for new samples, or the `percentile` (0-100) of the last `window` samples if it is set
+        super().__init__(base, max_exponent=max_exponent)
+        self.min_base = min_base
+        self.multiplier = multiplier
+        self.alpha = alpha
+        self.percentile = percentile
+        self.samples = deque(maxlen=window)
+        self.latency = None
+
+    def observe(self, latency):
+        self.samples.append(latency)
+        if self.percentile is not None:
+            samples = sorted(self.samples)
+            self.latency = samples[min(len(samples)-1, int(len(samples)*self.percentile/100))]
+        elif self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = self.alpha*latency + (1-self.alpha)*self.latency
+        log.debug(f'Observed latency {latency:.3f}s, base timeout is now {self.get_base():.3f}s')
+
+    def get_base(self):
+        if self.latency is None:
+            return self.base
+        return min(self.base, max(self.min_base, self.multiplier*self.latency))
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+import logging
+
+log = logging.getLogger(__name__)
+
+# Timers run their callbacks on the thread that handles received messages, so consensus state is only ever touched by one thread.
+# Times are UNIX timestamps in seconds.
+
+class Timers(ABC):
+    def now(self):
+        return time.time()
+
+    def call_at(self, when, callback):
+        # Runs `callback()` at time `when`. Returns a handle for `cancel`.
+        return self.call_later(when - self.now(), callback)
+
+    @abstractmethod
+    def call_later(self, delay, callback):
+        # Runs `callback()` after `delay` seconds. Returns a handle for `cancel`.
+        pass
+
+    @abstractmethod
+    def cancel(self, handle):
+        pass
+
+    @abstractmethod
+    def call_soon_threadsafe(self, callback):
+        # Runs `callback()` as soon as possible. Unlike the other methods, this can be called from any thread.
+        pass
+
+    def run_callback(self, callback):
+        # An exception in one callback must not stop the event loop, and with it every other timer
+        try:
+            callback()
+        except Exception:
+            log.error('Timer callback failed', exc_info=True)
+
+class AsyncioTimers(Timers):
+    def __init__(self, loop):
+        # Runs callbacks on the thread of the asyncio event loop `loop`
+        self.loop = loop
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(max(0, delay), self.run_callback, callback)
+
+    def cancel(self, handle):
+        handle.cancel()
+
+    def call_soon_threadsafe(self, callback):
+        self.loop.call_soon_threadsafe(self.run_callback, callback)
+
+class PikaTimers(Timers):
+    def __init__(self, connection):
+        # Runs callbacks on the thread that consumes from the `pika.BlockingConnection` `connection`
+        self.connection = connection
+
+    def call_later(self, delay, callback):
+        return self.connection.call_later(max(0, delay), lambda: self.run_callback(callback))
+
+    def cancel(self, handle):
+        self.connection.remove_timeout(handle)
+
+    def call_soon_threadsafe(self, callback):
+        self.connection.add_callback_threadsafe(lambda: self.run_callback(callback))
+
+class VirtualTimers(Timers):
+    def __init__(self, start_time=0.0):
+        # A virtual clock that only moves when the caller runs timers, for simulations and tests
+        self.time = start_time
+        self.queue = []
+        self.counter = itertools.count()
+        self.cancelled = set()
+        # Timers are run by a single thread, but `call_soon_threadsafe` is called from others, e.g. by `value_source.DrandSource`
+        self.lock = threading.RLock()
+
+    def now(self):
+        return self.time
+
+    def call_at(self, when, callback):
+        with self.lock:
+            handle = next(self.counter)
+            heapq.heappush(self.queue, (max(when, self.time), handle, callback))
+        return handle
+
+    def call_later(self, delay, callback):
+        return self.call_at(self.time + max(0, delay), callback)
+
+    def cancel(self, handle):
+        with self.lock:
+            self.cancelled.add(handle)
+
+    def call_soon_threadsafe(self, callback):
+        # The callback runs at the next `run_until`
+        return self.call_later(0, callback)
+
+    def next_time(self):
+        # Time of the next pending timer, or None if there is none
+        with self.lock:
+            while self.queue and self.queue[0][1] in self.cancelled:
+                self.cancelled.discard(heapq.heappop(self.queue)[1])
+            return self.queue[0][0] if self.queue else None
+
+    def run_until(self, until):
+        # Runs the timers that are due up to time `until` in order, then moves the clock to `until`
+        # Returns the number of callbacks that were run
+        count = 0
+        while True:
+            # Callbacks run without the lock, so they can set timers
+            with self.lock:
+                if self.next_time() is None or self.next_time() > until:
+                    break
+                when, handle, callback = heapq.heappop(self.queue)
+                self.time = when
+            self.run_callback(callback)
+            count += 1
+        with self.lock:
+            self.time = max(self.time, until)
+        return count
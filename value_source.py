@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import httpx
+from metrics import Counter, Histogram
+import logging
+
+log = logging.getLogger(__name__)
+
+# The public HTTP endpoints of the drand mainnet
+DRAND_ENDPOINTS = [
+    'https://drand.cloudflare.com/public',
+    'https://api.drand.sh/public',
+    'https://api2.drand.sh/public',
+    'https://api3.drand.sh/public',
+]
+
+DRAND_REQUESTS = Counter('drand_requests_total', 'Requests to drand endpoints, by endpoint and result', ['endpoint', 'result'])
+DRAND_FETCH_SECONDS = Histogram('drand_fetch_seconds', 'Time from the start of the fetch of a drand round to its value')
+LIGHTHOUSE_REQUESTS = Counter('lighthouse_requests_total', 'Requests to the Lighthouse API, by result', ['result'])
+LIGHTHOUSE_FETCH_SECONDS = Histogram('lighthouse_fetch_seconds', 'Time from the start of the fetch of an Eth2 slot to its block root')
+
+class BackgroundSource:
+    def __init__(self, name, fetch_seconds, prefetch=4, capacity=1024, timeout=2, retry_interval=1):
+        # Fetches values by key in the background, so that consensus never waits on a cold HTTP request
+        # Subclasses implement `fetch_once(key)`, which returns the value or None if it could not be fetched. Failed
+        # fetches are retried every `retry_interval` seconds, and their duration is observed in the `fetch_seconds` histogram.
+        # `prefetch` is the number of keys that `prefetch` fetches ahead. The futures of the last `capacity` keys are kept.
+        self.name = name
+        self.fetch_seconds = fetch_seconds
+        self.prefetch_keys = prefetch
+        self.capacity = capacity
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # `futures` maps key -> concurrent.futures.Future of its value, in least recently used order
+        self.futures = OrderedDict()
+        # Keys are requested by the consensus thread, and failed fetches are dropped on the thread of `loop`
+        self.lock = threading.Lock()
+        # Requests run on their own event loop in a background thread, same as `network.AsyncBroadcaster`
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(self._create_client(), self.loop).result()
+
+    async def _create_client(self):
+        return httpx.AsyncClient(timeout=self.timeout)
+
+    def get(self, key):
+        # Returns a concurrent.futures.Future of the value of `key`, and starts fetching it if needed
+        evicted = []
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.futures.move_to_end(key)
+                return future
+            future = asyncio.run_coroutine_threadsafe(self.fetch(key), self.loop)
+            self.futures[key] = future
+            while len(self.futures) > self.capacity:
+                evicted.append(self.futures.popitem(last=False)[1])
+        # Cancelling runs the callbacks of the future, which take the lock
+        for evicted_future in evicted:
+            evicted_future.cancel()
+        future.add_done_callback(lambda future: self.forget_failed(key, future))
+        return future
+
+    def forget_failed(self, key, future):
+        # A failed or cancelled fetch is not cached, so the next `get` starts over
+        if future.cancelled() or future.exception() is not None:
+            with self.lock:
+                if self.futures.get(key) is future:
+                    del self.futures[key]
+
+    def prefetch(self, first_key):
+        # Starts fetching `first_key` and the keys after it
+        for key in range(first_key, first_key + self.prefetch_keys):
+            self.get(key)
+
+    async def fetch(self, key):
+        started = time.perf_counter()
+        while True:
+            value = await self.fetch_once(key)
+            if value is not None:
+                self.fetch_seconds.observe(time.perf_counter() - started)
+                return value
+            log.warning(f'Failed to fetch {key} from {self.name}, retrying in {self.retry_interval}s')
+            await asyncio.sleep(self.retry_interval)
+
+    async def fetch_once(self, key):
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            futures = list(self.futures.values())
+        for future in futures:
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class DrandSource(BackgroundSource):
+    def __init__(self, endpoints=DRAND_ENDPOINTS, prefetch=4, capacity=1024, timeout=2, hedge_delay=0.5, retry_interval=1):
+        # Fetches drand randomness by round in the background
+        # `endpoints` are tried in order: the next one is also asked when no answer came within `hedge_delay` seconds,
+        # or as soon as all the requests started so far failed. The first valid answer wins.
+        # When all endpoints fail, e.g. because the round was not produced yet, the fetch is retried every `retry_interval` seconds.
+        self.endpoints = list(endpoints)
+        self.hedge_delay = hedge_delay
+        super().__init__('drand', DRAND_FETCH_SECONDS, prefetch=prefetch, capacity=capacity, timeout=timeout, retry_interval=retry_interval)
+
+    async def fetch_once(self, round):
+        # Hedged requests to the endpoints, returns the first valid randomness or None if all endpoints failed
+        endpoints = list(self.endpoints)
+        pending = set()
+        try:
+            while endpoints or pending:
+                if endpoints:
+                    pending.add(asyncio.ensure_future(self.request(endpoints.pop(0), round)))
+                done, pending = await asyncio.wait(pending, timeout=self.hedge_delay if endpoints else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        return None
+
+    async def request(self, endpoint, round):
+        # Returns the randomness of `round` from `endpoint`, or None if the request failed or the answer is not valid
+        url = f'{endpoint}/{round}'
+        try:
+            response = await self.client.get(url)
+        except httpx.HTTPError:
+            log.warning(f'drand request to {url} failed', exc_info=log.isEnabledFor(logging.DEBUG))
+            DRAND_REQUESTS.labels(endpoint, "error").inc()
+            return None
+        if response.status_code != 200:
+            log.debug(f'Failed GET from {url}, response status code: {response.status_code}')
+            DRAND_REQUESTS.labels(endpoint, "error").inc()
+            return None
+        try:
+            beacon = response.json()
+            randomness = beacon['randomness']
+            # drand randomness is the SHA-256 of the signature of the round, which catches corrupted or mixed up answers.
+            # The signature itself is not verified against the public key of the drand network.
+            valid = beacon['round'] == round and hashlib.sha256(bytes.fromhex(beacon['signature'])).hexdigest() == randomness
+        except (ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            log.warning(f'Invalid drand beacon from {url}')
+            DRAND_REQUESTS.labels(endpoint, "invalid").inc()
+            return None
+        DRAND_REQUESTS.labels(endpoint, "ok").inc()
+        return randomness
+
+class LighthouseSource(BackgroundSource):
+    def __init__(self, api='http://localhost:5052', prefetch=4, capacity=1024, timeout=2, retry_interval=1):
+        # Fetches the root of the Eth2 block in the fork choice of a Lighthouse node by slot in the background
+        # When the request fails, e.g. because the slot is not reached yet, it is retried every `retry_interval` seconds.
+        self.api = api
+        super().__init__('lighthouse', LIGHTHOUSE_FETCH_SECONDS, prefetch=prefetch, capacity=capacity, timeout=timeout, retry_interval=retry_interval)
+
+    async def fetch_once(self, slot):
+        # Returns the value of `slot` ("slot<slot>:<block root>"), or None if the request failed
+        url = self.api + '/beacon/block'
+        try:
+            response = await self.client.get(url, params={'slot': slot}, headers={'Accept': 'application/json'})
+        except httpx.HTTPError:
+            log.warning(f'Lighthouse request to {url} failed', exc_info=log.isEnabledFor(logging.DEBUG))
+            LIGHTHOUSE_REQUESTS.labels("error").inc()
+            return None
+        if response.status_code != 200:
+            log.debug(f'Failed GET from {url}, response status code: {response.status_code}')
+            LIGHTHOUSE_REQUESTS.labels("error").inc()
+            return None
+        try:
+            root = response.json()['root']
+            valid = type(root) == str
+        except (ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            log.warning(f'Invalid Lighthouse block from {url}')
+            LIGHTHOUSE_REQUESTS.labels("invalid").inc()
+            return None
+        LIGHTHOUSE_REQUESTS.labels("ok").inc()
+        return f'slot{slot}:{root}'
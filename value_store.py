@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import httpx
+import logging
+
+log = logging.getLogger(__name__)
+
+MISSING = object()
+
+def value_digest(value):
+    # Hex SHA-256 of the canonical JSON encoding of `value`
+    return hashlib.sha256(json.dumps(value, separators=(',', ':'), sort_keys=True).encode()).hexdigest()
+
+def fetched_value(future):
+    # The result of a future returned by `ValueStore.fetch`: the value, or None if no node had it or the fetch was cancelled
+    if future.cancelled() or future.exception() is not None:
+        return None
+    return future.result()
+
+def is_value_digest(value):
+    return type(value) == str and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+class ValueStore:
+    def __init__(self, peers, capacity=4096, timeout=1):
+        # Proposed values by digest, so that PREPARE, COMMIT and ROUND_CHANGE messages can carry only the digest of a value
+        # `peers` is the list of addresses of all nodes, indexed by node index. Values that this node never received are fetched from them.
+        # The last `capacity` values are kept, and served to other nodes at GET /values/<digest>
+        self.peers = peers
+        self.capacity = capacity
+        self.timeout = timeout
+        self.values = OrderedDict()
+        # `fetches` maps digest -> concurrent.futures.Future of a fetch in progress
+        self.fetches = {}
+        # Values are added by the message handler, served by the listener and fetched on the thread of `loop`
+        self.lock = threading.Lock()
+        # Fetches run on their own event loop in a background thread, same as `value_source.DrandSource`, so that the message
+        # handler never waits on a peer
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='values', daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(self._create_client(), self.loop).result()
+
+    async def _create_client(self):
+        return httpx.AsyncClient(timeout=self.timeout)
+
+    def put(self, value):
+        # Returns the digest of `value`
+        digest = value_digest(value)
+        with self.lock:
+            self.values[digest] = value
+            self.values.move_to_end(digest)
+            while len(self.values) > self.capacity:
+                self.values.popitem(last=False)
+        return digest
+
+    def get(self, digest, default=None):
+        with self.lock:
+            return self.values.get(digest, default)
+
+    def __contains__(self, digest):
+        with self.lock:
+            return digest in self.values
+
+    def fetch(self, digest, node_indices):
+        # Returns a concurrent.futures.Future of the value of `digest`, see `fetched_value`. A value that this node does not have
+        # is asked from the nodes in `node_indices`, in order, in the background until one of them returns it.
+        value = self.get(digest, MISSING)
+        if value is not MISSING:
+            future = concurrent.futures.Future()
+            future.set_result(value)
+            return future
+        with self.lock:
+            future = self.fetches.get(digest)
+            if future is not None:
+                return future
+            future = asyncio.run_coroutine_threadsafe(self.fetch_from_peers(digest, list(node_indices)), self.loop)
+            self.fetches[digest] = future
+        # The callback takes the lock, and runs right away if the fetch is already done
+        future.add_done_callback(lambda future: self.forget_fetch(digest, future))
+        return future
+
+    def forget_fetch(self, digest, future):
+        with self.lock:
+            if self.fetches.get(digest) is future:
+                del self.fetches[digest]
+
+    async def fetch_from_peers(self, digest, node_indices):
+        # Returns None if no node has the value
+        for node_index in node_indices:
+            url = f'http://{self.peers[node_index]}/values/{digest}'
+            try:
+                response = await self.client.get(url)
+            except httpx.HTTPError:
+                log.warning(f'Failed GET from {url}', exc_info=True)
+                continue
+            if response.status_code != 200:
+                log.debug(f'Failed GET from {url}, response status code: {response.status_code}')
+                continue
+            try:
+                value = response.json()
+            except ValueError:
+                log.warning(f'Malformed value from {url}')
+                continue
+            if value_digest(value) != digest:
+                log.warning(f'Value from {url} does not match its digest')
+                continue
+            log.info(f'Fetched value {digest} from node {node_index}')
+            self.put(value)
+            return value
+        log.error(f'No node returned the value of {digest}')
+        return None
+
+    def close(self):
+        with self.lock:
+            futures = list(self.fetches.values())
+        for future in futures:
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def handle_get(self, path, headers, body):
+        # Handler of the GET /values/ route of `network.HTTPListener`
+        value = self.get(path.rsplit('/', 1)[1], MISSING)
+        if value is MISSING:
+            return 404, 'text/plain', b'Unknown value'
+        return 200, 'application/json', json.dumps(value).encode()
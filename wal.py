@@ -0,0 +1,232 @@
+import os
+import mmap
+import struct
+import zlib
+from consensus import ConsensusStore, ConsensusMessage, DecodeFrame, encode_dict, decode_dict
+import logging
+
+log = logging.getLogger(__name__)
+
+# Write-ahead log of a ConsensusStore
+# A log file is a sequence of records: payload length (u32), CRC-32 of kind and payload (u32), kind (u8), payload.
+# A torn record at the end of the file, from a crash in the middle of a write, is dropped on replay.
+RECORD_HEADER = struct.Struct('>IIB')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+# MESSAGE: weight of the sender (u32), then the binary encoding of the message
+# FIELDS: dict of store fields, encoded like the data of a binary message
+# QUORUM: height of the messages (u64), then a dict with the round, type and messages of a quorum. The messages are stored in full,
+# since the tallies they come from can be pruned.
+# PROPOSAL: binary encoding of the last PRE_PREPARE proposed by this node
+RECORD_MESSAGE, RECORD_FIELDS, RECORD_QUORUM, RECORD_PROPOSAL = range(1, 5)
+
+def encode_record(kind, payload):
+    kind_and_payload = bytes([kind]) + payload
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(kind_and_payload), kind) + payload
+
+def read_records(path):
+    # Returns the list of (kind, payload) of the valid records of the file at `path`, and the length of the valid prefix of the file
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return [], 0
+    records = []
+    offset = 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        while offset + RECORD_HEADER.size <= len(m):
+            length, crc, kind = RECORD_HEADER.unpack_from(m, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > len(m):
+                break
+            payload = m[offset + RECORD_HEADER.size:end]
+            if zlib.crc32(bytes([kind]) + payload) != crc:
+                break
+            records.append((kind, payload))
+            offset = end
+        if offset != len(m):
+            log.warning(f'Dropping {len(m) - offset} bytes of torn records at the end of {path}')
+    return records, offset
+
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def delete_store(path):
+    # Deletes the files of the PersistentConsensusStore at `path`, which must be closed
+    for suffix in ['.snap', '.wal', '.snap.tmp']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    fsync_directory(path)
+
+def write_expired_height(directory, height):
+    # Records that the heights up to `height` are decided and their stores can be deleted, so that a restarted worker
+    # resumes after `height` instead of running the deleted heights again from empty stores
+    path = os.path.join(directory, 'expired_height')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(U64.pack(height))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    fsync_directory(path)
+
+def read_expired_height(directory):
+    # Returns the height recorded by `write_expired_height`, or None
+    path = os.path.join(directory, 'expired_height')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return U64.unpack(f.read())[0]
+
+class WriteAheadLog:
+    def __init__(self, path, valid_length=None):
+        # Appends records to the file at `path`. Records are buffered until `sync`, which writes them with a single fsync.
+        # `valid_length`, if given, is the length of the valid prefix of the file, the rest is truncated
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if valid_length is not None and os.fstat(self.fd).st_size > valid_length:
+            os.ftruncate(self.fd, valid_length)
+        self.buffer = []
+        # Number of records in the file
+        self.count = 0
+
+    def append(self, kind, payload):
+        self.buffer.append(encode_record(kind, payload))
+        self.count += 1
+
+    def sync(self):
+        if not self.buffer:
+            return
+        os.write(self.fd, b''.join(self.buffer))
+        os.fsync(self.fd)
+        self.buffer = []
+
+    def truncate(self):
+        # Drops all records, after they were written to a snapshot
+        self.buffer = []
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.count = 0
+
+    def close(self):
+        self.sync()
+        os.close(self.fd)
+
+class PersistentConsensusStore(ConsensusStore):
+    def __init__(self, node_id, peers, path, snapshot_interval=1024):
+        # Keeps the store in `<path>.snap` (a compact snapshot) and `<path>.wal` (the records written since the snapshot)
+        # Records are made durable by `sync`, which `Consensus.broadcast` calls before sending a message, so a node never sends
+        # a message that its state after a restart would not account for. Records that were not synced only describe received messages.
+        # A new snapshot is written and the log is emptied once it holds `snapshot_interval` records, so replay is bounded by the snapshot interval.
+        super().__init__(node_id, peers)
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.wal = None
+        snapshot_records, _ = read_records(path + '.snap')
+        wal_records, valid_length = read_records(path + '.wal')
+        for kind, payload in snapshot_records + wal_records:
+            self.replay(kind, payload)
+        self.recovered = len(snapshot_records) + len(wal_records) > 0
+        if self.recovered:
+            log.info(f'Recovered {path} from {len(snapshot_records)} snapshot and {len(wal_records)} log records: round {self.round}, state {self.state}')
+        self.wal = WriteAheadLog(path + '.wal', valid_length)
+        self.wal.count = len(wal_records)
+
+    def replay(self, kind, payload):
+        if kind == RECORD_MESSAGE:
+            super().add_message(ConsensusMessage.from_bytes(payload[U32.size:]), U32.unpack_from(payload)[0])
+        elif kind == RECORD_FIELDS:
+            fields, offset = decode_dict(payload, 0, DecodeFrame(0))
+            for name, value in fields.items():
+                setattr(self, name, value)
+        elif kind == RECORD_QUORUM:
+            quorum, offset = decode_dict(payload, U64.size, DecodeFrame(U64.unpack_from(payload)[0]))
+            # A quorum record can be replayed twice after a crash between writing a snapshot and emptying the log
+            if self.get_quorum_messages(quorum['round'], quorum['type']) == []:
+                super().add_quorum_messages(quorum['round'], quorum['type'], list(quorum['messages']))
+        elif kind == RECORD_PROPOSAL:
+            self.proposal = ConsensusMessage.from_bytes(payload)
+        else:
+            log.warning(f'Skipping record of unknown kind {kind} in {self.path}')
+
+    def append_fields(self, **fields):
+        parts = []
+        encode_dict(fields, parts, {})
+        self.wal.append(RECORD_FIELDS, b''.join(parts))
+
+    def set_state(self, state: str):
+        super().set_state(state)
+        self.append_fields(state=state)
+
+    def set_round(self, round: int):
+        super().set_round(round)
+        self.append_fields(round=round)
+
+    def set_prepared_round(self, prepared_round: int):
+        super().set_prepared_round(prepared_round)
+        self.append_fields(prepared_round=prepared_round)
+
+    def set_prepared_value(self, prepared_value):
+        super().set_prepared_value(prepared_value)
+        self.append_fields(prepared_value=prepared_value)
+
+    def set_decided_value(self, decided_value):
+        super().set_decided_value(decided_value)
+        self.append_fields(decided_value=decided_value)
+
+    def set_proposal(self, proposal):
+        super().set_proposal(proposal)
+        self.wal.append(RECORD_PROPOSAL, proposal.to_bytes())
+
+    def add_message(self, message: ConsensusMessage, weight=1):
+        if not super().add_message(message, weight):
+            return False
+        self.wal.append(RECORD_MESSAGE, U32.pack(weight) + message.to_bytes())
+        return True
+
+    def add_quorum_messages(self, round: int, type: str, messages):
+        super().add_quorum_messages(round, type, messages)
+        self.wal.append(RECORD_QUORUM, self.encode_quorum(round, type, messages))
+
+    def encode_quorum(self, round, type, messages):
+        parts = [U64.pack(messages[0].height if messages else 0)]
+        encode_dict({'round': round, 'type': type, 'messages': list(messages)}, parts, {})
+        return b''.join(parts)
+
+    def sync(self):
+        self.wal.sync()
+        if self.wal.count >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot(self):
+        # Writes the whole store to a new snapshot, then empties the log
+        # Fields come first, so that replaying the messages applies the retention of the current round
+        parts = []
+        encode_dict({'state': self.state, 'round': self.round, 'prepared_round': self.prepared_round, 'prepared_value': self.prepared_value, 'decided_value': self.decided_value}, parts, {})
+        records = [encode_record(RECORD_FIELDS, b''.join(parts))]
+        for round, tallies in self.tallies.items():
+            for type, tally in tallies.items():
+                for sender, message in tally.messages.items():
+                    records.append(encode_record(RECORD_MESSAGE, U32.pack(tally.weights[sender]) + message.to_bytes()))
+        for round, quorums in self.quorum_messages.items():
+            for type, messages in quorums.items():
+                if messages:
+                    records.append(encode_record(RECORD_QUORUM, self.encode_quorum(round, type, messages)))
+        for sender, (message, weight) in self.highest_round_changes.items():
+            if message.round > self.round + self.future_rounds:
+                # Only kept as the highest ROUND_CHANGE of its sender
+                records.append(encode_record(RECORD_MESSAGE, U32.pack(weight) + message.to_bytes()))
+        if self.proposal is not None:
+            records.append(encode_record(RECORD_PROPOSAL, self.proposal.to_bytes()))
+        temporary_path = self.path + '.snap.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path + '.snap')
+        fsync_directory(self.path)
+        self.wal.truncate()
+        log.debug(f'Wrote snapshot {self.path}.snap with {len(records)} records')
+
+    def close(self):
+        self.wal.close()
@@ -0,0 +1,57 @@
+import argparse
+import timeit
+from consensus import ConsensusMessage, create_certificate
+
+# python3 wire-benchmark.py --nodes 4,16,64,128
+# Compares the JSON and binary wire formats on the largest message of the protocol: a PRE_PREPARE
+# whose justification holds a quorum of ROUND_CHANGE messages, one of which carries the certificate of a quorum of PREPARE messages
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--nodes",
+    type = str,
+    default = "4,16,64,128",
+    help = "Comma-separated list of network sizes to benchmark"
+)
+parser.add_argument(
+    "--repeat",
+    type = int,
+    default = 0,
+    help = "Number of encode/decode repetitions per measurement. Picked per network size if 0"
+)
+args = parser.parse_args()
+
+def make_pre_prepare(num_nodes, value='f'*64, round=3):
+    quorum = num_nodes - (num_nodes-1)//3
+    prepares = [ConsensusMessage("PREPARE", round-1, {'value': value}, sender, signature='s'*128) for sender in range(quorum)]
+    certificate = create_certificate(prepares)
+    # Only the first ROUND_CHANGE message keeps its certificate, see `Consensus.create_justification`
+    rc_data = lambda sender: {'prepared_round': round-1, 'prepared_value': value, **({'certificate': certificate} if sender == 0 else {})}
+    round_changes = [ConsensusMessage("ROUND_CHANGE", round, rc_data(sender), sender, signature='s'*128) for sender in range(quorum)]
+    return ConsensusMessage("PRE_PREPARE", round, {'value': value, 'justification': round_changes}, 0, signature='s'*128)
+
+def measure(function, repeat):
+    return min(timeit.repeat(function, number=repeat, repeat=3)) / repeat
+
+def rebroadcast(message):
+    # A new message that embeds the same, already serialized, justification
+    return ConsensusMessage(message.type, message.round, dict(message.data), message.sender, signature=message.siganture)
+
+if __name__ == '__main__':
+    # enc: encoding a message whose justification was never serialized before
+    # re-enc: encoding a new message around a justification that was already serialized, e.g. a re-broadcast quorum
+    print(f'{"N":>5} {"json bytes":>12} {"binary bytes":>13} {"ratio":>6} {"json enc ms":>12} {"bin enc ms":>11} {"json re-enc ms":>15} {"bin re-enc ms":>14} {"json dec ms":>12} {"bin dec ms":>11}')
+    for num_nodes in [int(n) for n in args.nodes.split(',')]:
+        message = make_pre_prepare(num_nodes)
+        json_body = message.to_string().encode()
+        binary_body = message.to_bytes()
+        assert ConsensusMessage.decode(binary_body).to_dict() == ConsensusMessage.decode(json_body).to_dict(), "Wire formats disagree"
+        repeat = args.repeat or max(1, 20000 // (num_nodes*num_nodes))
+        build = measure(lambda: make_pre_prepare(num_nodes), repeat)
+        json_encode = measure(lambda: make_pre_prepare(num_nodes).to_string().encode(), repeat) - build
+        binary_encode = measure(lambda: make_pre_prepare(num_nodes).to_bytes(), repeat) - build
+        json_reencode = measure(lambda: rebroadcast(message).to_string().encode(), repeat)
+        binary_reencode = measure(lambda: rebroadcast(message).to_bytes(), repeat)
+        json_decode = measure(lambda: ConsensusMessage.decode(json_body), repeat)
+        binary_decode = measure(lambda: ConsensusMessage.decode(binary_body), repeat)
+        print(f'{num_nodes:>5} {len(json_body):>12} {len(binary_body):>13} {len(binary_body)/len(json_body):>6.2f} {json_encode*1000:>12.3f} {binary_encode*1000:>11.3f} {json_reencode*1000:>15.3f} {binary_reencode*1000:>14.3f} {json_decode*1000:>12.3f} {binary_decode*1000:>11.3f}')
@@ -0,0 +1,435 @@
+import os
+import math
+import datetime
+import pika, sys
+import asyncio
+import atexit
+import threading
+from consensus import ConsensusNode, ConsensusStore, JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE, decode_messages
+from network import AsyncBroadcaster, HTTPListener
+from broker import queue_name
+from signing import MessageSigner, SignatureVerifier
+from manager import ConsensusManager
+from value_store import ValueStore
+from timers import AsyncioTimers, PikaTimers
+from timeout_policy import ExponentialTimeout, AdaptiveTimeout
+from leader_schedule import RoundRobinSchedule, WeightedSchedule
+from wal import PersistentConsensusStore, delete_store, write_expired_height, read_expired_height
+from relay import RelayTree, RelayBroadcaster
+from metrics import REGISTRY, Gauge
+from logs import SampledLog, set_sampling, start_queue_logging
+import logging
+
+# Shared setup and main loop of the consensus worker scripts (consensus-worker.py, drand-consensus-worker.py, lighthouse-consensus-worker.py)
+
+log = logging.getLogger(__name__)
+# Logs of every received message
+message_log = SampledLog(log)
+
+QUEUE_DEPTH = Gauge('consensus_queue_depth', 'Messages waiting in the RabbitMQ queue of this node (broker transport)')
+
+def add_arguments(parser):
+    parser.add_argument(
+        "-n", "--nodes",
+        type = str,
+        default = "localhost:9000",
+        help = "Comma-separated list of IPs of all the nodes"
+    )
+    parser.add_argument(
+        "--node_identity",
+        type = int,
+        default = -1,
+        help = "Node index corresponding to this node"
+    )
+    parser.add_argument(
+        "-b", "--byz_quorum",
+        type = int,
+        default = 1,
+        help = "Weight corresponding to a Byzantine quorum"
+    )
+    parser.add_argument(
+        "--rc_threshold",
+        type = int,
+        default = 1,
+        help = "Weight of the ROUND_CHANGE threshold"
+    )
+    parser.add_argument(
+        "--round_duration",
+        type = int,
+        default = 1,
+        help = "Duration (in seconds) of one round of the IBFT protocol"
+    )
+    parser.add_argument(
+        "--timeout_policy",
+        type = str,
+        choices = ["exponential", "adaptive"],
+        default = "exponential",
+        help = "'exponential' doubles the round timeout every round starting from --round_duration, 'adaptive' also shrinks the timeout of round 1 to a multiple of the observed decision latency, up to --round_duration"
+    )
+    parser.add_argument(
+        "--start_time",
+        type = int,
+        default = math.ceil(datetime.datetime.timestamp(datetime.datetime.now()))+2,
+        help = "Start time (as UNIX timestamp) for the protocol"
+    )
+    parser.add_argument(
+        "--first_height",
+        type = int,
+        default = 0,
+        help = "Height of the first consensus instance"
+    )
+    parser.add_argument(
+        "--heights",
+        type = int,
+        default = 1,
+        help = "Number of consecutive heights to decide, 0 to keep deciding heights forever"
+    )
+    parser.add_argument(
+        "--pipeline_depth",
+        type = int,
+        default = 1,
+        help = "Number of heights that run at the same time. Height h+1 starts once height h has a PREPARE quorum"
+    )
+    parser.add_argument(
+        "--digest_values",
+        action = "store_true",
+        help = "Send only the digest of the proposed value in PREPARE, COMMIT and ROUND_CHANGE messages. Nodes that miss the value fetch it from GET /values/<digest> of their peers (--transport direct only)"
+    )
+    parser.add_argument(
+        "--weights",
+        type = str,
+        default = "",
+        help = "Comma-separated list of the weights of all the nodes, in the order of --nodes. All nodes have weight 1 if empty"
+    )
+    parser.add_argument(
+        "--leader_schedule",
+        type = str,
+        choices = ["round_robin", "weighted"],
+        default = "round_robin",
+        help = "'round_robin' rotates the leader over all nodes every round and height, 'weighted' lets each node lead a share of the rounds proportional to its weight"
+    )
+    parser.add_argument(
+        "--wal_dir",
+        type = str,
+        default = "",
+        help = "Directory in which the state of every height is persisted, so that a restarted worker continues where it stopped. State is kept in memory only if empty"
+    )
+    parser.add_argument(
+        "--private_key",
+        type = str,
+        default = "",
+        help = "Hex Ed25519 private key of this node, used to sign its messages (see `python3 signing.py`)"
+    )
+    parser.add_argument(
+        "--public_keys",
+        type = str,
+        default = "",
+        help = "Comma-separated list of the hex Ed25519 public keys of all the nodes, in the order of --nodes. Signatures are not checked if empty"
+    )
+    parser.add_argument(
+        "--transport",
+        type = str,
+        choices = ["broker", "direct"],
+        default = "broker",
+        help = "'broker' consumes messages from RabbitMQ (fed by flask-server.py), 'direct' runs an HTTP listener inside the worker process"
+    )
+    parser.add_argument(
+        "--wire_format",
+        type = str,
+        choices = ["binary", "json"],
+        default = "binary",
+        help = "Wire format of sent messages. Received messages are accepted in both formats, and peers that reject binary messages are sent JSON"
+    )
+    parser.add_argument(
+        "--coalesce_window",
+        type = float,
+        default = 0,
+        help = "Messages to the same peer that are sent within this many seconds (e.g. 0.002) are sent in one batch request. Every message is sent on its own if 0"
+    )
+    parser.add_argument(
+        "--coalesce_max",
+        type = int,
+        default = 64,
+        help = "Maximum number of messages in a batch request"
+    )
+    parser.add_argument(
+        "--urgent_types",
+        type = str,
+        default = "PRE_PREPARE",
+        help = "Comma-separated list of message types that are sent right away, without waiting for --coalesce_window"
+    )
+    parser.add_argument(
+        "--dissemination",
+        type = str,
+        choices = ["direct", "tree"],
+        default = "direct",
+        help = "'direct' sends every message to all nodes, 'tree' sends PRE_PREPARE and ROUND_CHANGE messages to --fanout nodes per relay tree, which relay them to the others"
+    )
+    parser.add_argument(
+        "--fanout",
+        type = int,
+        default = 8,
+        help = "Number of nodes that every node relays a message to, per relay tree (--dissemination tree)"
+    )
+    parser.add_argument(
+        "--relay_trees",
+        type = int,
+        default = 2,
+        help = "Number of relay trees every message is sent along, so that a crashed relay does not cut off the nodes below it (--dissemination tree)"
+    )
+    parser.add_argument(
+        "--listen_host",
+        type = str,
+        default = "0.0.0.0",
+        help = "Host on which the listener of the 'direct' transport binds"
+    )
+    parser.add_argument(
+        "--port",
+        type = int,
+        default = None,
+        help = "Port of the listener of the 'direct' transport. Defaults to the port of this node in --nodes"
+    )
+    parser.add_argument(
+        "--max_body_size",
+        type = int,
+        default = 16*1024*1024,
+        help = "Maximum size (in bytes) of a request body accepted by the listener of the 'direct' transport. Larger requests get 413"
+    )
+    parser.add_argument(
+        "--log_level",
+        type = str,
+        choices = ["DEBUG", "INFO", "WARNING", "ERROR"],
+        default = "INFO",
+        help = "Level of the logs of the worker"
+    )
+    parser.add_argument(
+        "--log_sample",
+        type = int,
+        default = 1,
+        help = "Only log one in every LOG_SAMPLE received, processed and sent messages (logged at DEBUG)"
+    )
+    parser.add_argument(
+        "--async_logging",
+        action = "store_true",
+        help = "Format and write logs on a background thread instead of the thread that processes messages"
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type = int,
+        default = None,
+        help = "Port of a separate listener for GET /metrics. The listener of the 'direct' transport always serves GET /metrics"
+    )
+
+def setup_logging(args, logger_names, name_width=9):
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(f'%(asctime)s - %(name)-{name_width}s - %(levelname)8s - Node:{args.node_identity} - %(message)s')
+    ch.setFormatter(formatter)
+    handler = ch
+    if args.async_logging:
+        handler = start_queue_logging(ch)
+    level = getattr(logging, args.log_level)
+    set_sampling(args.log_sample)
+
+    log.setLevel(level)
+    log.addHandler(handler)
+    for logger in logging.Logger.manager.loggerDict.values():
+        if isinstance(logger, logging.PlaceHolder):
+            continue
+        if logger.name in logger_names:
+            logger.setLevel(level)
+            logger.addHandler(handler)
+
+def run(args, consensus_class, instance_kwargs=None, routes=(), **consensus_kwargs):
+    # `instance_kwargs`, if given, is called as instance_kwargs(height) and returns extra arguments for the instance of that height
+    # `routes` is a list of extra (method, path, handler) routes of the listener of the 'direct' transport, see `network.HTTPListener.add_route`
+    peers = args.nodes.split(',')
+
+    public_keys = args.public_keys.split(',') if args.public_keys else ["" for peer in peers]
+    assert len(public_keys) == len(peers), "--public_keys must have one key per node"
+    weights = [int(weight) for weight in args.weights.split(',')] if args.weights else [1 for peer in peers]
+    assert len(weights) == len(peers), "--weights must have one weight per node"
+    nodes = {}
+    for node in [ConsensusNode(i, weight=weights[i], public_key=public_keys[i]) for i in range(len(peers))]:
+        nodes[node.node_index] = node
+    # The leader table is computed once for all heights
+    if args.leader_schedule == "weighted":
+        leader_schedule = WeightedSchedule(nodes)
+    else:
+        leader_schedule = RoundRobinSchedule(nodes)
+    byz_quorum = args.byz_quorum
+    rc_threshold = args.rc_threshold
+    round_duration = datetime.timedelta(seconds=args.round_duration)
+    # Shared by all heights, so that the adaptive policy learns across heights
+    if args.timeout_policy == "adaptive":
+        timeout_policy = AdaptiveTimeout(args.round_duration)
+    else:
+        timeout_policy = ExponentialTimeout(args.round_duration)
+    start_time = datetime.datetime.fromtimestamp(args.start_time)
+    node_identity = args.node_identity
+    if node_identity < 0:
+        node_identity = None
+
+    urgent_types = [type for type in args.urgent_types.split(',') if type]
+    broadcaster = AsyncBroadcaster(peers, wire_format=args.wire_format, coalesce_window=args.coalesce_window, coalesce_max=args.coalesce_max, urgent_types=urgent_types)
+    atexit.register(lambda: broadcaster.close())
+    # Shared by the relay and the instances of all heights, so that every message is verified once
+    verifier = SignatureVerifier(nodes)
+    relay = None
+    if args.dissemination == "tree":
+        # All nodes must use the same tree parameters
+        relay = RelayBroadcaster(broadcaster, peers, node_identity, RelayTree(nodes, fanout=args.fanout, trees=args.relay_trees), verifier)
+    signer = MessageSigner(args.private_key) if args.private_key else None
+    if args.digest_values:
+        # Shared by all heights, and served to other nodes
+        value_store = ValueStore(peers)
+        consensus_kwargs['value_store'] = value_store
+        routes = list(routes) + [('GET', '/values/', value_store.handle_get)]
+
+    # A restarted worker resumes after the heights whose stores were deleted, see `on_expired`
+    first_height = args.first_height
+    num_heights = args.heights if args.heights > 0 else None
+    if args.wal_dir:
+        os.makedirs(args.wal_dir, exist_ok=True)
+        expired_height = read_expired_height(args.wal_dir)
+        if expired_height is not None and expired_height >= first_height:
+            # The store of the last expired height is left behind by a crash between recording it and deleting it
+            delete_store(os.path.join(args.wal_dir, f'height_{expired_height}'))
+            log.info(f'Heights up to {expired_height} were already decided, resuming at height {expired_height + 1}')
+            if num_heights is not None:
+                num_heights = max(0, num_heights - (expired_height + 1 - first_height))
+            first_height = expired_height + 1
+
+    if args.metrics_port is not None:
+        serve_metrics(args.listen_host, args.metrics_port)
+
+    # Messages, round timers and leader proposals are all handled on the thread of the transport, which owns `timers`
+    if args.transport == "direct":
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        timers = AsyncioTimers(loop)
+    else:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+        timers = PikaTimers(connection)
+
+    def wal_path(height):
+        return os.path.join(args.wal_dir, f'height_{height}')
+
+    def create_instance(height):
+        if args.wal_dir:
+            store = PersistentConsensusStore(node_identity, peers, wal_path(height))
+        else:
+            store = ConsensusStore(node_identity, peers)
+        kwargs = dict(consensus_kwargs)
+        if instance_kwargs is not None:
+            kwargs.update(instance_kwargs(height))
+        return consensus_class(nodes, byz_quorum, rc_threshold, round_duration, start_time, store, node_identity=node_identity, broadcaster=relay if relay is not None else broadcaster, signer=signer, height=height, timers=timers, timeout_policy=timeout_policy, leader_schedule=leader_schedule, verifier=verifier, **kwargs)
+
+    def on_decided(height, value):
+        log.info(f'Height {height} decided on value: {value}')
+
+    def on_expired(height):
+        # Heights older than the retained ones are never replayed or served again
+        if args.wal_dir:
+            write_expired_height(args.wal_dir, height)
+            delete_store(wal_path(height))
+
+    def send(messages, node_index):
+        # COMMIT quorums for nodes that fell behind go straight to the node, not along the relay trees
+        for message in messages:
+            broadcaster.broadcast(message, [peers[node_index]])
+
+    manager = ConsensusManager(create_instance, timers, first_height=first_height, num_heights=num_heights, on_decided=on_decided, window=max(4, args.pipeline_depth), retention=max(16, args.pipeline_depth), pipeline_depth=args.pipeline_depth, send=send, verifier=verifier, on_expired=on_expired)
+
+    def handle_message(body):
+        # `body` is a single message or a batch of messages
+        messages = decode_messages(body)
+        if relay is not None:
+            # Relayed first, so that the nodes below this one do not wait for it to process the messages. Duplicates and messages
+            # with invalid signatures are dropped.
+            messages = [message for message in messages if relay.relay(message)]
+            if not messages:
+                return []
+        for message in messages:
+            message_log.debug('Received message: %s', message)
+        if len(messages) == 1:
+            return [manager.process_message(messages[0])]
+        return manager.process_messages(messages)
+
+    log.info(f'Start time: {start_time}')
+    manager.start_height(first_height, start_time)
+
+    try:
+        if args.transport == "direct":
+            run_direct(args, loop, peers, node_identity, handle_message, routes)
+        else:
+            if routes:
+                log.warning(f'Routes {[path for method, path, handler in routes]} are only served with --transport direct')
+            run_broker(connection, node_identity, handle_message)
+    except KeyboardInterrupt:
+        log.info('Interrupted')
+        sys.exit(0)
+
+def serve_metrics(host, port):
+    # Serves GET /metrics on its own listener, in a background thread, whatever the transport
+    loop = asyncio.new_event_loop()
+    listener = HTTPListener()
+    listener.add_route('GET', '/metrics', REGISTRY.handle_get)
+    loop.run_until_complete(listener.start(host, port))
+    threading.Thread(target=loop.run_forever, name='metrics', daemon=True).start()
+
+def run_broker(connection, node_identity, handle_message, queue_depth_interval=1):
+    # `queue_depth_interval` is the interval (in seconds) at which the depth of the queue is polled for the metrics
+    channel = connection.channel()
+    channel.queue_declare(queue=queue_name(node_identity))
+
+    def callback(ch, method, properties, body):
+        # Messages are auto-acked, a malformed one is dropped instead of stopping the consumer
+        try:
+            handle_message(body)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            log.error('Received malformed message', exc_info=True)
+
+    channel.basic_consume(queue=queue_name(node_identity), on_message_callback=callback, auto_ack=True)
+
+    def update_queue_depth():
+        QUEUE_DEPTH.set(channel.queue_declare(queue=queue_name(node_identity), passive=True).method.message_count)
+        connection.call_later(queue_depth_interval, update_queue_depth)
+    update_queue_depth()
+    log.info('Waiting for messages. To exit press CTRL+C')
+    channel.start_consuming()
+
+def run_direct(args, loop, peers, node_identity, handle_message, routes=()):
+    # Single-process node: received messages go straight into `process_message`, without Flask and RabbitMQ in between
+    port = args.port
+    if port is None:
+        assert node_identity is not None, "--port is required for a node without --node_identity"
+        port = int(peers[node_identity].rsplit(':', 1)[1])
+
+    def post_messages(path, headers, body):
+        if headers.get('content-type', JSON_CONTENT_TYPE).split(';')[0].strip() not in [JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE]:
+            return 415, 'text/plain', b'Unsupported message format'
+        try:
+            handle_message(body)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            log.error('Received malformed message', exc_info=True)
+            return 400, 'text/plain', b'Malformed message'
+        return 200, 'text/plain', b'POST received'
+
+    def get_messages(path, headers, body):
+        return 200, 'text/plain', b'Hello from the consensus worker!'
+
+    listener = HTTPListener(max_body_size=args.max_body_size)
+    listener.add_route('POST', '/messages', post_messages)
+    listener.add_route('GET', '/messages', get_messages)
+    listener.add_route('GET', '/metrics', REGISTRY.handle_get)
+    for method, path, handler in routes:
+        listener.add_route(method, path, handler)
+
+    loop.run_until_complete(listener.start(args.listen_host, port))
+    log.info('Waiting for messages. To exit press CTRL+C')
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(listener.stop())
+        loop.close()